@@ -1,23 +1,25 @@
 #!/usr/bin/env python3.9
 # -*- coding: utf-8 -*-
 
-import os
+import time
+
+STARTED_AT = time.perf_counter()
+
+import multiprocessing
 import random
 import re
+import sys
 import textwrap
-import uuid
 from datetime import datetime as dt
+from queue import Queue
 
 import pytz
 import sentry_sdk
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
-from emoji import UNICODE_EMOJI
-from tabulate import tabulate
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
+from telegram.utils.request import Request
 from telegram.ext import (
     Updater,
+    JobQueue,
     CommandHandler,
     ConversationHandler,
     CallbackQueryHandler,
@@ -29,6 +31,7 @@ from app.bot_utils import (
     get_status_reply,
     restricted,
     refresh_main_page,
+    leave_main_page,
     in_out,
     remove_game_jobs,
     remove_player_and_clean_game,
@@ -36,8 +39,21 @@ from app.bot_utils import (
     create_game_and_add_player,
     get_chettam_data,
     hours_keyboard,
-    sync_games,
+    sweep_expired_games,
+    restore_reminders,
     restricted_dayoff,
+    unit_of_work,
+)
+from app.dispatcher import ChatOrderedDispatcher
+from app.models import check_schema
+from app.outbound import RateLimitedBot
+from app.webhook import ShardedWebhook, feed_dispatcher
+from app.render import (
+    render,
+    render_games_chart,
+    render_sticker,
+    sticker_height,
+    RenderError,
 )
 from app.utils import (
     logger,
@@ -46,10 +62,14 @@ from app.utils import (
     get_game,
     slot_status,
     chop,
-    get_all_data,
-    player_query,
+    get_stats_data,
     get_all_players_in_games,
     get_chat,
+    parse_in_out,
+    InOut,
+    load_leetcode_problems,
+    refresh_leetcode_problems,
+    import_costs,
 )
 from app.vars import (
     DEBUG,
@@ -65,10 +85,14 @@ from app.vars import (
     COMMON_TIMEZONES,
     USAGE_TEXT,
     USERNAME_COLORS,
-    COLORS,
     SECONDARY_STATE,
     WEEKDAYS,
     EXTENDED_HOURS,
+    WORKERS,
+    WEBHOOK_WORKERS,
+    EXPIRY_SWEEP_INTERVAL,
+    LEETCODE_CACHE_TTL,
+    STARTUP_BUDGET,
 )
 
 
@@ -78,48 +102,40 @@ def error(update, context):
 
 
 # Command actions
+@unit_of_work
 @restricted
 @restricted_dayoff
-@sync_games
 def status(update, context):
     """Get games status for current chat"""
     reply = get_status_reply(update)
     update.message.reply_markdown(reply)
 
 
+@unit_of_work
 @restricted
 @restricted_dayoff
-@sync_games
 def slot_in_out(update, context):
-    lines = [line for line in update.message.text.split("/") if line != ""]
-    for line in lines:
-        command = line.split()[0].lower()
-        args = line.split()[1:]
-        if args:
-            if command in chop("in"):
-                in_out(update, context, action="in", hard_args=args)
-            elif command in chop("out"):
-                in_out(update, context, action="out", hard_args=args)
-        else:
-            update.message.reply_markdown(USAGE_TEXT)
-            return
+    chat = get_chat(update.effective_chat)
+    plan = parse_in_out(update.message.text, chat.main_hours)
+    if plan is None:
+        update.message.reply_markdown(USAGE_TEXT)
+        return
+    in_out(update, context, plan)
     update.message.reply_markdown(get_status_reply(update))
 
 
+@unit_of_work
 @restricted
 @restricted_dayoff
-@sync_games
 def all_in_out(update, context):
     args = context.args
-    if args and args[0] == "in":
-        in_out(update, context, action="in", hard_args=["all"])
-    elif args and args[0] == "out":
-        in_out(update, context, action="out", hard_args=["all"])
+    if args and args[0] in ["in", "out"]:
+        in_out(update, context, [InOut(action=args[0], hours=None)])
     update.message.reply_markdown(get_status_reply(update))
 
 
+@unit_of_work
 @restricted
-@sync_games
 def menu(update, context):
     keyboard = [
         [InlineKeyboardButton("Set user's nickname", callback_data="user_nickname")],
@@ -143,6 +159,7 @@ def menu(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def user_timezone(update, context):
     """Set current user's timezone"""
     query = update.callback_query
@@ -165,6 +182,7 @@ def user_timezone(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def set_user_timezone(update, context):
     query = update.callback_query
     new_tz = re.search("TZ_user_(.*)", query.data).group(1)
@@ -176,6 +194,7 @@ def set_user_timezone(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def user_nickname(update, context):
     query = update.callback_query
     player = get_player(update)
@@ -190,6 +209,7 @@ def user_nickname(update, context):
     return SECONDARY_STATE
 
 
+@unit_of_work
 def set_user_nickname(update, context):
     nickname = update.message.text
     sanitized_nickname = nickname.strip().replace("\n", " ")[:30]
@@ -200,6 +220,7 @@ def set_user_nickname(update, context):
     return ConversationHandler.END
 
 
+@unit_of_work
 def who_is_who(update, context):
     query = update.callback_query
     players = get_all_players_in_games(update)
@@ -212,6 +233,7 @@ def who_is_who(update, context):
     return ConversationHandler.END
 
 
+@unit_of_work
 def set_days_off(update, context):
     query = update.callback_query
     chat = get_chat(update.effective_chat)
@@ -233,6 +255,7 @@ def set_days_off(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def weekday_rm(update, context):
     query = update.callback_query
     weekday = re.search("weekday_rm_(.*)", query.data).group(1)
@@ -243,6 +266,7 @@ def weekday_rm(update, context):
     return ConversationHandler.END
 
 
+@unit_of_work
 def weekday_add(update, context):
     query = update.callback_query
     weekday = re.search("weekday_add_(.*)", query.data).group(1)
@@ -253,6 +277,7 @@ def weekday_add(update, context):
     return ConversationHandler.END
 
 
+@unit_of_work
 def set_game_hours(update, context):
     query = update.callback_query
     chat = get_chat(update.effective_chat)
@@ -280,6 +305,7 @@ def set_game_hours(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def hour_rm(update, context):
     query = update.callback_query
     hour = int(re.search("hour_rm_(.*)", query.data).group(1))
@@ -290,6 +316,7 @@ def hour_rm(update, context):
     return ConversationHandler.END
 
 
+@unit_of_work
 def hour_add(update, context):
     query = update.callback_query
     hour = int(re.search("hour_add_(.*)", query.data).group(1))
@@ -300,6 +327,7 @@ def hour_add(update, context):
     return ConversationHandler.END
 
 
+@unit_of_work
 def chat_timezone(update, context):
     """Set current user's timezone"""
     query = update.callback_query
@@ -322,6 +350,7 @@ def chat_timezone(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def set_chat_timezone(update, context):
     query = update.callback_query
     new_tz = re.search("TZ_chat_(.*)", query.data).group(1)
@@ -333,44 +362,33 @@ def set_chat_timezone(update, context):
     return MAIN_STATE
 
 
-import matplotlib.pyplot as plt
-
-
+@unit_of_work
 def data(update, context):
     query = update.callback_query
-    df = get_all_data(chat_id=update.effective_chat.id)
-    table, graph = data_games_played(df)
+    players_df, days_df = get_stats_data(chat_id=update.effective_chat.id)
+    table = data_games_played(players_df)
     query.edit_message_text(text=f"```\n{table}```", parse_mode=ParseMode.MARKDOWN)
-    context.bot.send_photo(chat_id=update.effective_chat.id, photo=open(graph, "rb"))
-    os.remove(graph)
+    try:
+        graph = render(
+            render_games_chart, days_df.index.tolist(), days_df["games"].tolist()
+        )
+    except RenderError as e:
+        logger().warning(f"Games chart was not rendered: {e}")
+        context.bot.send_message(
+            chat_id=update.effective_chat.id, text="Chart is busy, try again later"
+        )
+    else:
+        context.bot.send_photo(chat_id=update.effective_chat.id, photo=graph)
     return ConversationHandler.END
 
 
-def data_games_played(df):
-    df = df[df["in_queue"] == False]
-    df = df[df["expired"] == True]
-    uniq_players = df["player_id"].value_counts()
-    # TODO: queue
-    data_table = [
-        [str(player_query(player_id)), count]
-        for player_id, count in uniq_players.iteritems()
-    ]
-    # per date
-    df["timeslot"] = df["timeslot"].dt.date
-    df = df.groupby("timeslot").nunique()
-    df["game_id"].plot(
-        x="game_id",
-        y="Games played",
-        title="Games per day",
-        figsize=(15, 6),
-        rot=45,
-        kind="bar",
+def data_games_played(players_df):
+    from tabulate import tabulate
+
+    data_table = players_df[["player", "games_played", "games_queued"]].values.tolist()
+    return tabulate(
+        tabular_data=data_table, headers=["Player", "Games played", "In queue"]
     )
-    graph = f"./temp_{uuid.uuid4().hex}.png"
-    plt.tight_layout()
-    plt.savefig(graph, dpi=300)
-    table = tabulate(tabular_data=data_table, headers=["Player", "Games played"])
-    return table, graph
 
 
 # def data_popular_timeslot(df):
@@ -380,9 +398,9 @@ def data_games_played(df):
 
 
 # Conversation actions
+@unit_of_work
 @restricted
 @restricted_dayoff
-@sync_games
 def chettam(update, context):
     """Entry point for conversation"""
     reply, keyboard = get_chettam_data(update, context)
@@ -390,7 +408,7 @@ def chettam(update, context):
     return MAIN_STATE
 
 
-@sync_games
+@unit_of_work
 def pick_hour(update, context):
     """Choice of hours"""
     query = update.callback_query
@@ -401,6 +419,7 @@ def pick_hour(update, context):
             InlineKeyboardButton(f"{Emoji.check} Done", callback_data="status_conv"),
         ]
     )
+    leave_main_page(query)
     query.answer()
     query.edit_message_text(
         text=f"{Emoji.clock} Choose time:",
@@ -409,71 +428,93 @@ def pick_hour(update, context):
     return MAIN_STATE
 
 
+@unit_of_work
 def new_game(update, context):
     """Create new game"""
     query = update.callback_query
     player = get_player(update)
     timeslot = convert_to_dt(timeslot=query.data, timezone=player.timezone_pytz)
-    create_game_and_add_player(update, context, player, timeslot)
+    # Hour picker can be stale, updates of the chat are ordered so the check is safe
+    game = get_game(update.effective_chat.id, timeslot=timeslot)
+    if not game:
+        create_game_and_add_player(update, context, player, timeslot)
+    elif not game.has_player(player):
+        game.add_player(player, joined_at=dt.now(pytz.utc))
     return refresh_main_page(update, context, query)
 
 
+@unit_of_work
 def join(update, context):
     """Join current game"""
     query = update.callback_query
     player = get_player(update)
     game_id = re.search("[0-9]+", query.data).group(0)
     game = get_game(update.effective_chat.id, game_id=game_id)
-    game.add_player(player, joined_at=dt.now(pytz.utc))
+    # Main page can be stale: the game expired or the player has already joined
+    if game and not game.has_player(player):
+        game.add_player(player, joined_at=dt.now(pytz.utc))
     return refresh_main_page(update, context, query)
 
 
+@unit_of_work
 def leave(update, context):
     """Leave current game"""
     query = update.callback_query
     player = get_player(update)
     game_id = re.search("[0-9]+", query.data).group(0)
     game = get_game(update.effective_chat.id, game_id=game_id)
-    remove_player_and_clean_game(context, game, player)
+    # Main page can be stale: the game expired or the player has already left
+    if game and game.has_player(player):
+        remove_player_and_clean_game(context, game, player)
     return refresh_main_page(update, context, query)
 
 
+@unit_of_work
 def call(update, context):
     """Mention all players about current game"""
     query = update.callback_query
     game_id = re.search("[0-9]+", query.data).group(0)
     game = get_game(update.effective_chat.id, game_id=game_id)
+    if not game:
+        # Main page is stale, the game expired since it was rendered
+        return refresh_main_page(update, context, query)
     player = get_player(update)
+    leave_main_page(query)
     query.answer()
     query.edit_message_text(
         text=slot_status(game, timezone=player.timezone_pytz),
         parse_mode=ParseMode.MARKDOWN,
     )
+    # Drop pending reminders first, so only the call itself is left scheduled
+    remove_game_jobs(context, game)
     schedule_game_notification(
         context=context,
         update=update,
         game=game,
         message="go go!",
     )
-    remove_game_jobs(context, game, delay=0.1)
     return ConversationHandler.END
 
 
+@unit_of_work
 def status_conv(update, context):
     """Get games status for current chat"""
     query = update.callback_query
     reply = get_status_reply(update)
+    leave_main_page(query)
     query.answer()
     query.edit_message_text(text=reply, parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 
+@unit_of_work
 def back(update, context):
     """Back to main page"""
     query = update.callback_query
     return refresh_main_page(update, context, query)
 
 
+@unit_of_work
 def get_sticker(update, context):
     """Replies with an image of the forwarded message"""
     msg = update.message
@@ -485,75 +526,45 @@ def get_sticker(update, context):
         else:
             profile_photo = None
 
-        font_size = 20
-        img_w = 450
-        img_h = 80
-        padding_l = 30
-
         wrapped_text = textwrap.fill(text=msg.text, width=25)
-        print(wrapped_text)
-        for char in wrapped_text:
-            if char in UNICODE_EMOJI:
-                print(char)
-                font_family = "./.fonts/Apple Color Emoji.ttc"
-                # wrapped_text = char
-
-        for _ in wrapped_text.split("\n"):
-            img_h += font_size + 2
-
-        if img_h > 512:
+        if sticker_height(wrapped_text) > 512:
             msg.reply_text(text="max height reached (512px")
             return
 
-        bg_params = {
-            "mode": "RGBA",
-            "size": (img_w, img_h),
-            "color": COLORS["white"],
-        }
-
-        # Create the image
-        img = Image.new(**bg_params)
-        font_family = "./.fonts/LucidaGrande.ttc"
-        font = ImageFont.truetype(font=font_family, size=font_size, index=0)
-        font_bold = ImageFont.truetype(font=font_family, size=font_size, index=1)
-
-        # img.paste(im=profile_photo, box=(0, 0))
-        r = 25
-        x = padding_l + r
-        y = 45
-        leftUpPoint = (x - r, y - r)
-        rightDownPoint = (x + r, y + r)
         user_color = random.choice(list(USERNAME_COLORS.values()))
-
-        draw = ImageDraw.Draw(img)
-        draw.ellipse(xy=(leftUpPoint, rightDownPoint), fill=user_color)
-        draw.text(
-            xy=(padding_l + 2 * r + 20, 20),
-            text=target_user.full_name,
-            fill=user_color,
-            font=font_bold,
-            embedded_color=True,
-        )
-        draw.text(
-            xy=(padding_l + 2 * r + 20, 50),
-            text=wrapped_text,
-            fill=COLORS["black"],
-            font=font,
-            # font=ImageFont.truetype(font="./.fonts/Apple Color Emoji.ttc", size=20, index=0),
-            embedded_color=True,
-        )
-
-        # Save an image and send it
-        temp_file = f"./temp_{uuid.uuid4().hex}.png"
-        img.save(temp_file, dpi=(300, 300), quality=95)
-        msg.reply_photo(photo=open(temp_file, "rb"))
-        os.remove(temp_file)
-
-
-def main():
-    """Run bot"""
-    updater = Updater(token=TOKEN, use_context=True)
-    updater.bot.set_my_commands(commands=COMMANDS)
+        try:
+            sticker = render(
+                render_sticker, target_user.full_name, wrapped_text, user_color
+            )
+        except RenderError as e:
+            logger().warning(f"Sticker was not rendered: {e}")
+            return
+        msg.reply_photo(photo=sticker)
+
+
+def report_startup(updater, startup_time):
+    """Print import costs and startup time, fail if it's over the budget"""
+    updater.stop()
+    print("Slowest imports (cumulative ms):")
+    for cost, module in import_costs():
+        print(f"{cost:10.1f}  {module}")
+    print(f"Ready in {startup_time:.2f}s, budget is {STARTUP_BUDGET}s")
+    if startup_time > STARTUP_BUDGET:
+        sys.exit(1)
+
+
+def build_updater(shard=None) -> Updater:
+    """Creates updater with all handlers and jobs.
+    Worker process of sharded webhook gets its (index, shards) pair,
+    its jobs only touch chats of its own shard."""
+    bot = RateLimitedBot(token=TOKEN, request=Request(con_pool_size=WORKERS + 4))
+    if shard:
+        bot.limiter.share(shard[1])
+    dispatcher = ChatOrderedDispatcher(
+        bot, Queue(), job_queue=JobQueue(), workers=0, chat_workers=WORKERS
+    )
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -561,28 +572,37 @@ def main():
     # Log all errors
     dp.add_error_handler(callback=error)
 
+    # Jobs
+    updater.job_queue.run_repeating(
+        callback=sweep_expired_games,
+        interval=EXPIRY_SWEEP_INTERVAL,
+        # Reads skip outdated games anyway
+        first=EXPIRY_SWEEP_INTERVAL,
+        context=shard,
+        name="sweep_expired_games",
+    )
+    updater.job_queue.run_once(callback=restore_reminders, when=0, context=shard)
+    updater.job_queue.run_repeating(
+        callback=refresh_leetcode_problems,
+        interval=LEETCODE_CACHE_TTL,
+        # Fresh copy on disk is served until it's out of date
+        first=load_leetcode_problems(),
+        name="refresh_leetcode_problems",
+    )
+
     # Handlers
-    dp.add_handler(CommandHandler(command="status", callback=status, run_async=True))
-    dp.add_handler(CommandHandler(command="all", callback=all_in_out, run_async=True))
+    dp.add_handler(CommandHandler(command="status", callback=status))
+    dp.add_handler(CommandHandler(command="all", callback=all_in_out))
     dp.add_handler(
         CommandHandler(
             command=chop("in", upper=True) + chop("out", upper=True),
             callback=slot_in_out,
-            run_async=True,
         )
     )
     dp.add_handler(
         ConversationHandler(
-            entry_points=[
-                CommandHandler(
-                    command=chop("chettam"), callback=chettam, run_async=True
-                )
-            ],
-            fallbacks=[
-                CommandHandler(
-                    command=chop("chettam"), callback=chettam, run_async=True
-                )
-            ],
+            entry_points=[CommandHandler(command=chop("chettam"), callback=chettam)],
+            fallbacks=[CommandHandler(command=chop("chettam"), callback=chettam)],
             states={
                 MAIN_STATE: [
                     CallbackQueryHandler(callback=join, pattern="^join_[0-9]+$"),
@@ -650,6 +670,42 @@ def main():
     dp.add_handler(
         MessageHandler(filters=Filters.text & Filters.forwarded, callback=get_sticker)
     )
+    return updater
+
+
+def run_shard(index, shards, queue):
+    """Worker process of sharded webhook"""
+    sentry_sdk.init(SENTRY_DSN)
+    feed_dispatcher(build_updater(shard=(index, shards)), queue)
+
+
+def serve_sharded(shards):
+    """Runs webhook receiver routing updates by chat to {shards} worker processes"""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(shards)]
+    workers = [
+        context.Process(target=run_shard, args=(index, shards, queue))
+        for index, queue in enumerate(queues)
+    ]
+    for worker in workers:
+        worker.start()
+    server = ShardedWebhook((HOST, PORT), TOKEN, queues)
+    Bot(token=TOKEN).set_webhook(url=APP_URL + TOKEN)
+    logger().info(f"Webhook is routing updates to {shards} workers")
+    server.serve_until_stopped()
+    for worker in workers:
+        worker.join()
+
+
+def main(profile=False):
+    """Run bot"""
+    check_schema()
+    Bot(token=TOKEN).set_my_commands(commands=COMMANDS)
+    if WEBHOOK_WORKERS > 1 and not DEBUG and not profile:
+        serve_sharded(WEBHOOK_WORKERS)
+        return
+
+    updater = build_updater()
     # Start
     if DEBUG:
         # Start the Bot (polling method)
@@ -662,6 +718,11 @@ def main():
             url_path=TOKEN,
             webhook_url=APP_URL + TOKEN,
         )
+    startup_time = time.perf_counter() - STARTED_AT
+    logger().info(f"Bot is ready in {startup_time:.2f}s")
+    if profile:
+        report_startup(updater, startup_time)
+        return
 
     # Block until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
@@ -671,4 +732,4 @@ def main():
 
 if __name__ == "__main__":
     sentry_sdk.init(SENTRY_DSN)
-    main()
+    main(profile="--profile-startup" in sys.argv)
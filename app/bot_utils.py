@@ -1,25 +1,34 @@
-import re
-import time
-from datetime import datetime as dt, timedelta
+import threading
+from collections import defaultdict
+from datetime import datetime as dt
+from functools import wraps
 
 import pytz
+from cachetools import LRUCache
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
+from telegram.error import BadRequest
 
+from app.models import session, Reminder, naive_utc
+from app.outbound import background
 from app.utils import (
     is_dayoff,
     get_leetcode_problem,
     get_all_games,
     slot_status_all,
     get_player,
-    convert_to_dt,
+    hour_to_dt,
     get_game,
     game_timediff,
     row_list_chunks,
     slot_time_header,
     create_game,
-    get_assoc,
     get_time_header,
     get_chat,
+    expire_games,
+    get_reminder,
+    get_upcoming_reminders,
+    delete_reminders,
+    logger,
 )
 from app.vars import (
     DEBUG,
@@ -28,12 +37,76 @@ from app.vars import (
     STICKERS,
     MAIN_STATE,
     Emoji,
+    REMINDERS,
+    MAIN_PAGE_EDIT_DELAY,
 )
 
 
+# Scheduled jobs by game id, so cancelling doesn't scan the whole job queue
+game_jobs = defaultdict(set)
+game_jobs_lock = threading.Lock()
+
+
+def register_game_job(game_id, job):
+    with game_jobs_lock:
+        game_jobs[game_id].add(job)
+
+
+def unregister_game_job(game_id, job):
+    with game_jobs_lock:
+        jobs = game_jobs.get(game_id)
+        if jobs:
+            jobs.discard(job)
+            if not jobs:
+                del game_jobs[game_id]
+
+
+# Keyboards of "New" game picker by (chat id, timezone, main hours, date, hour)
+hours_keyboards = LRUCache(maxsize=256)
+hours_keyboards_version = defaultdict(int)
+hours_keyboards_lock = threading.Lock()
+
+# Latest update waiting to be rendered and last rendered content of main pages,
+# both by (chat id, message id)
+main_page_updates = {}
+main_page_renders = LRUCache(maxsize=1000)
+# Bumped when the message switches to another page, so a pending edit doesn't bring the main page back
+main_page_versions = LRUCache(maxsize=1000)
+main_page_lock = threading.Lock()
+
+
+def unit_of_work(func):
+    """Run handler in its own DB session, committed once at the end of the update"""
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+            session.commit()
+            for callback in session.info.pop("after_commit", []):
+                callback()
+            return result
+        except:
+            session.rollback()
+            raise
+        finally:
+            if DEBUG:
+                queries = session.info.get("queries", 0)
+                logger().info(f"{func.__name__}: {queries} DB queries")
+            session.remove()
+
+    return wrapped
+
+
+def after_commit(callback):
+    """Run callback once the current update's changes are committed"""
+    session.info.setdefault("after_commit", []).append(callback)
+
+
 def restricted_dayoff(func):
     """Restrict prod bot usage to allowed chats only"""
 
+    @wraps(func)
     def wrapped(update, context, *args, **kwargs):
         chat = get_chat(update.effective_chat)
         if is_dayoff(chat):
@@ -47,6 +120,7 @@ def restricted_dayoff(func):
 def restricted(func):
     """Restrict prod bot usage to allowed chats only"""
 
+    @wraps(func)
     def wrapped(update, context, *args, **kwargs):
         chat = get_chat(update.effective_chat)
         if DEBUG or chat.id in ALLOWED_CHATS_INTERNAL + ALLOWED_CHATS_EXTERNAL:
@@ -59,19 +133,17 @@ def restricted(func):
     return wrapped
 
 
-def sync_games(func):
-    """Checks if games are expired"""
-
-    def wrapped(update, context, *args, **kwargs):
-        for game in get_all_games(update):
-            if game_timediff(game, hours=1):
-                game.expired = True
-                game.save()
-        return func(update, context, *args, **kwargs)
-
-    return wrapped
+@unit_of_work
+def sweep_expired_games(context):
+    """Periodic job that expires outdated games of all chats, or of the worker's shard"""
+    expired = expire_games(shard=context.job.context)
+    if expired:
+        logger().info(f"{len(expired)} games expired")
+        for chat_id in set(chat_id for _, chat_id in expired):
+            invalidate_hours_keyboard(chat_id)
 
 
+@unit_of_work
 def dayoff(update, context):
     """Dayoff messages"""
     try:
@@ -86,7 +158,7 @@ def dayoff(update, context):
 
 
 def get_status_reply(update):
-    games = get_all_games(update)
+    games = get_all_games(update, roster=True)
     player = get_player(update)
     if games:
         return slot_status_all(games, timezone=player.timezone_pytz)
@@ -97,15 +169,16 @@ def get_status_reply(update):
 # Conversation helper functions
 def get_chettam_data(update, context):
     """Reply message and keyboard for entry point"""
-    games = get_all_games(update)
+    games = get_all_games(update, roster=True)
     player = get_player(update)
     keyboard = []
     if games:
         reply = slot_status_all(games, timezone=player.timezone_pytz)
         for game in games:
             btn_row = []
+            assoc = game.get_assoc(player)
 
-            if player in game.players:
+            if assoc:
                 btn_text = f"{Emoji.cross} Leave"
                 btn_callback = f"leave_{game.id}"
             else:
@@ -121,8 +194,8 @@ def get_chettam_data(update, context):
             if (
                 game.slots > 1
                 and game_timediff(game, minutes=-30)
-                and player in game.players
-                and not get_assoc(game.id, player.id).in_queue
+                and assoc
+                and not assoc.in_queue
             ):
                 btn_row.append(
                     InlineKeyboardButton(
@@ -144,29 +217,109 @@ def get_chettam_data(update, context):
     return reply, keyboard
 
 
-@sync_games
 def refresh_main_page(update, context, query):
-    """Reload main page buttons"""
-    reply, keyboard = get_chettam_data(update, context)
+    """Reload main page buttons. Edits of the same message are coalesced,
+    only the latest update is rendered after MAIN_PAGE_EDIT_DELAY."""
     query.answer()
-    query.edit_message_text(
-        reply,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.MARKDOWN,
-    )
+    key = (query.message.chat_id, query.message.message_id)
+
+    def schedule_edit():
+        with main_page_lock:
+            scheduled = key in main_page_updates
+            main_page_updates[key] = update
+        if not scheduled:
+            context.job_queue.run_once(
+                edit_main_page, when=MAIN_PAGE_EDIT_DELAY, context=key
+            )
+
+    after_commit(schedule_edit)
     return MAIN_STATE
 
 
+def leave_main_page(query):
+    """Cancel pending main page edit of the message before showing another page in it"""
+    key = (query.message.chat_id, query.message.message_id)
+    with main_page_lock:
+        main_page_updates.pop(key, None)
+        main_page_versions[key] = main_page_versions.get(key, 0) + 1
+
+
+@unit_of_work
+def edit_main_page(context):
+    """Render main page for the latest update and edit the message if it changed"""
+    key = context.job.context
+    with main_page_lock:
+        update = main_page_updates.pop(key, None)
+        version = main_page_versions.get(key, 0)
+    if update is None:
+        return
+    reply, keyboard = get_chettam_data(update, context)
+    markup = InlineKeyboardMarkup(keyboard)
+    render = (reply, markup.to_json())
+    # Message could have been switched to another page since the last render
+    shown_markup = update.callback_query.message.reply_markup
+    with main_page_lock:
+        if main_page_versions.get(key, 0) != version:
+            return
+        if (
+            main_page_renders.get(key) == render
+            and shown_markup
+            and shown_markup.to_json() == render[1]
+        ):
+            return
+    chat_id, message_id = key
+    try:
+        context.bot.edit_message_text(
+            reply,
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=markup,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    with main_page_lock:
+        main_page_renders[key] = render
+
+
+def invalidate_hours_keyboard(chat_id):
+    """Drop cached keyboards of the chat once current changes are committed"""
+
+    def invalidate():
+        with hours_keyboards_lock:
+            hours_keyboards_version[chat_id] += 1
+            for key in [key for key in hours_keyboards if key[0] == chat_id]:
+                del hours_keyboards[key]
+
+    after_commit(invalidate)
+
+
 def hours_keyboard(update):
-    """Returns keyboard with timeslots for new game"""
+    """Returns keyboard with timeslots for new game.
+    It only changes when an hour passes, so it's cached until then
+    or until a game in the chat is created or expired."""
     player = get_player(update)
     chat = get_chat(update.effective_chat)
     timezone = player.timezone_pytz
-    main_hours_dt = [
-        convert_to_dt(timeslot=f"{hour:02d}:00", timezone=timezone)
-        for hour in chat.main_hours
-    ]
-    ts_games = get_all_games(update, ts_only=True)
+    now = dt.now(timezone)
+    key = (chat.id, timezone.zone, tuple(chat.main_hours), now.date(), now.hour)
+    with hours_keyboards_lock:
+        keyboard = hours_keyboards.get(key)
+        version = hours_keyboards_version[chat.id]
+    if keyboard is None:
+        keyboard = build_hours_keyboard(update, chat, timezone)
+        with hours_keyboards_lock:
+            # Don't cache if games changed while it was built
+            if hours_keyboards_version[chat.id] == version:
+                hours_keyboards[key] = keyboard
+    # Callers append their own rows
+    return list(keyboard)
+
+
+def build_hours_keyboard(update, chat, timezone):
+    main_hours_dt = [hour_to_dt(hour, timezone) for hour in chat.main_hours]
+    ts_games = set(get_all_games(update, ts_only=True))
     ts_filtered = [
         timeslot.astimezone(timezone).strftime("%H:%M")
         for timeslot in main_hours_dt
@@ -179,101 +332,136 @@ def hours_keyboard(update):
     return row_list_chunks(keyboard)
 
 
-def in_out(update, context, action, hard_args=None):
-    """Ugliest function of them all"""
-    args = hard_args if hard_args else context.args
+def in_out(update, context, plan):
+    """Execute join/leave plan for current player.
+    Games are loaded with one query and all changes are written with one flush."""
+    player = get_player(update)
     chat = get_chat(update.effective_chat)
-    if args:
-        player = get_player(update)
-        if args[0].lower() == "all":
-            for game in get_all_games(update):
-                if action == "in" and player not in game.players:
-                    game.add_player(player, joined_at=dt.now(pytz.utc))
-
-                elif action == "out" and player in game.players:
-                    remove_player_and_clean_game(context, game, player)
-        else:
-            filtered_args = expand_hours(
-                chat=chat,
-                hours_list=[
-                    argv
-                    for argv in args
-                    if re.search("^[0-9]+-[0-9]+$", argv) or re.search("^[0-9]+$", argv)
-                ],
-            )
-            for argv in filtered_args:
-                timeslot = convert_to_dt(
-                    timeslot=f"{int(argv):02d}:00",
-                    timezone=player.timezone_pytz,
-                )
-                game = get_game(chat_id=chat.id, timeslot=timeslot)
-
-                if action == "in":
-                    if not game and timeslot > dt.now(pytz.utc):
-                        create_game_and_add_player(update, context, player, timeslot)
-                    elif game and player not in game.players:
-                        game.add_player(player, joined_at=dt.now(pytz.utc))
-
-                elif action == "out":
-                    if game and player in game.players:
-                        remove_player_and_clean_game(context, game, player)
-
-
-def expand_hours(chat, hours_list):
-    """18-21 -> [18, 19, 20, 21]"""
-    result = []
-    for hour in hours_list:
-        if re.search("^[0-9]+-[0-9]+$", hour):
-            hour_pair = hour.split("-")
-            hours_indexes = {hour: idx for idx, hour in enumerate(chat.main_hours)}
-            first_hour = int(hour_pair[0])
-            first_hour_index = hours_indexes.get(first_hour)
-            last_hour = int(hour_pair[1])
-            last_hour_index = hours_indexes.get(last_hour)
-            if (
-                first_hour in chat.main_hours
-                and last_hour in chat.main_hours
-                and first_hour_index < last_hour_index
-            ):
-                result.extend(chat.main_hours[first_hour_index : last_hour_index + 1])
+    games = {game.timeslot_utc: game for game in get_all_games(update, roster=True)}
+    new_games, changed_games = [], set()
+    for step in plan:
+        if step.hours is None:
+            timeslots = list(games)
         else:
-            if int(hour) in chat.main_hours:
-                result.append(int(hour))
-    return set(result)
+            timeslots = [hour_to_dt(hour, player.timezone_pytz) for hour in step.hours]
+        for timeslot in timeslots:
+            game = games.get(timeslot)
+            if step.action == "in":
+                if not game and timeslot > dt.now(pytz.utc):
+                    game = create_game(chat, timeslot, flush=False)
+                    games[timeslot] = game
+                    new_games.append(game)
+                if game and not game.has_player(player):
+                    game.join(player, joined_at=dt.now(pytz.utc))
+                    changed_games.add(game)
+
+            elif step.action == "out":
+                if game and game.has_player(player):
+                    game.leave(player)
+                    changed_games.add(game)
+
+    empty_games = [game for game in changed_games if not game.player_game]
+    for game in empty_games:
+        game.expired = True
+    for game in new_games:
+        if not game.expired:
+            add_reminders(context, game)
+    session.flush()
+
+    for game in changed_games:
+        game.expire_roster(player)
+    for game in empty_games:
+        remove_game_jobs(context, game)
+    if new_games or empty_games:
+        invalidate_hours_keyboard(chat.id)
+
+
+def notify_game(bot, game, prefix, timezone, message):
+    """Mention active players of the game with a message"""
+    bot.send_message(
+        chat_id=game.chat_id,
+        text=f"\[_{prefix}_] *{slot_time_header(game, timezone=timezone)}*: {game.players_call_active} {message}",
+        parse_mode=ParseMode.MARKDOWN,
+    )
 
 
 def schedule_game_notification(context, update, game, message, when=0, auto=False):
     """Send a separate message"""
     player = get_player(update)
     tz = player.timezone_pytz
+    prefix = "auto" if auto else str(player)
+    chat_id = update.effective_chat.id
+    game_id = game.id
 
+    @background
+    @unit_of_work
     def send_msg(ctx):
-        if auto:
-            prefix = "auto"
-        else:
-            prefix = player
-        ctx.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"\[_{prefix}_] *{slot_time_header(game, timezone=tz)}*: {game.players_call_active} {message}",
-            parse_mode=ParseMode.MARKDOWN,
-        )
+        unregister_game_job(game_id, ctx.job)
+        # Job runs in another thread, so the game is loaded in its own session
+        current_game = get_game(chat_id, game_id=game_id)
+        if current_game:
+            notify_game(ctx.bot, current_game, prefix, tz, message)
+
+    job = context.job_queue.run_once(send_msg, when=when, name=f"{game_id}_{when}")
+    register_game_job(game_id, job)
+
+
+def add_reminders(context, game):
+    """Store reminders of a new game, their jobs are scheduled after commit"""
+    reminders = []
+    for kind, (before, _) in REMINDERS.items():
+        fire_at = game.timeslot_utc - before
+        if fire_at > dt.now(pytz.utc):
+            reminders.append(Reminder(game=game, kind=kind, fire_at=naive_utc(fire_at)))
+    session.add_all(reminders)
+
+    def schedule():
+        for reminder in reminders:
+            schedule_reminder(context.job_queue, reminder)
+
+    after_commit(schedule)
+
+
+def schedule_reminder(job_queue, reminder):
+    """Schedule job for reminder stored in DB"""
+    job = job_queue.run_once(
+        send_reminder,
+        when=reminder.fire_at_utc,
+        context=reminder.id,
+        name=f"{reminder.game_id}_reminder_{reminder.id}",
+    )
+    register_game_job(reminder.game_id, job)
+
 
-    context.job_queue.run_once(send_msg, when=when, name=f"{game.id}_{when}")
+@background
+@unit_of_work
+def send_reminder(context):
+    """Send stored reminder and forget it"""
+    reminder = get_reminder(context.job.context)
+    if not reminder:
+        return
+    unregister_game_job(reminder.game_id, context.job)
+    game = reminder.game
+    if not game.expired and game.players:
+        _, message = REMINDERS[reminder.kind]
+        notify_game(context.bot, game, "auto", game.chat.timezone_pytz, message)
+    reminder.delete()
+
+
+@unit_of_work
+def restore_reminders(context):
+    """Startup job that schedules reminders stored before restart"""
+    delete_reminders(shard=context.job.context)
+    for reminder in get_upcoming_reminders(shard=context.job.context):
+        schedule_reminder(context.job_queue, reminder)
 
 
 def create_game_and_add_player(update, context, player, timeslot):
     """Self-explanatory"""
     game = create_game(update.effective_chat, timeslot)
     game.add_player(player, joined_at=dt.now(pytz.utc))
-    for minutes in [5]:
-        schedule_game_notification(
-            context=context,
-            update=update,
-            game=game,
-            message=f"game starts in {minutes} mins!",
-            when=game.timeslot_utc - timedelta(minutes=minutes),
-            auto=True,
-        )
+    add_reminders(context, game)
+    invalidate_hours_keyboard(game.chat_id)
 
 
 def remove_player_and_clean_game(context, game, player):
@@ -282,11 +470,13 @@ def remove_player_and_clean_game(context, game, player):
     if not game.players:
         game.expired = True
         remove_game_jobs(context, game)
+        invalidate_hours_keyboard(game.chat_id)
 
 
-def remove_game_jobs(context, game, delay=0):
+def remove_game_jobs(context, game):
     """Remove all jobs for given game"""
-    time.sleep(delay)
-    for job in context.job_queue.jobs():
-        if job.name.startswith(f"{game.id}_"):
-            job.schedule_removal()
+    delete_reminders(game.id)
+    with game_jobs_lock:
+        jobs = game_jobs.pop(game.id, set())
+    for job in jobs:
+        job.schedule_removal()
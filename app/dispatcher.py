@@ -0,0 +1,77 @@
+import threading
+from collections import deque
+from queue import Queue
+
+from telegram.ext import Dispatcher
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    """Handles updates of a chat one after another in arrival order, different chats in parallel.
+    Every chat with pending updates has its own queue, a shared pool of {chat_workers} threads
+    takes turns on them: a chat holds a thread only while one of its updates is handled.
+    Handlers run there instead of 'run_async', so conversation states are returned synchronously."""
+
+    def __init__(self, *args, chat_workers, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_workers = chat_workers
+        # Chat id -> pending updates, a chat is here while it's waiting or being handled
+        self.chat_queues = {}
+        self.chat_lock = threading.Lock()
+        self.chats_idle = threading.Condition(self.chat_lock)
+        # Chats with a pending update, each chat appears at most once
+        self.ready_chats = Queue()
+        self.chat_threads = []
+
+    def start(self, ready=None):
+        if not self.chat_threads:
+            for index in range(self.chat_workers):
+                thread = threading.Thread(
+                    target=self.run_chats, name=f"chat_worker_{index}"
+                )
+                thread.start()
+                self.chat_threads.append(thread)
+        super().start(ready)
+
+    def process_update(self, update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            super().process_update(update)
+            return
+        with self.chat_lock:
+            pending = self.chat_queues.get(chat.id)
+            if pending is not None:
+                pending.append(update)
+                return
+            self.chat_queues[chat.id] = deque([update])
+        self.ready_chats.put(chat.id)
+
+    def run_chats(self):
+        for chat_id in iter(self.ready_chats.get, None):
+            with self.chat_lock:
+                update = self.chat_queues[chat_id].popleft()
+            try:
+                super().process_update(update)
+            finally:
+                self.finish_update(chat_id)
+
+    def finish_update(self, chat_id):
+        with self.chat_lock:
+            if self.chat_queues[chat_id]:
+                # Back of the line, so a busy chat doesn't keep the thread
+                self.ready_chats.put(chat_id)
+            else:
+                del self.chat_queues[chat_id]
+                if not self.chat_queues:
+                    self.chats_idle.notify_all()
+
+    def stop(self):
+        """Stops after updates already queued for chats are handled"""
+        super().stop()
+        with self.chat_lock:
+            while self.chat_queues:
+                self.chats_idle.wait()
+        for _ in self.chat_threads:
+            self.ready_chats.put(None)
+        for thread in self.chat_threads:
+            thread.join()
+        self.chat_threads = []
@@ -1,4 +1,6 @@
+import os
 from datetime import datetime as dt, timedelta
+from functools import lru_cache
 
 import pytz
 from sqlalchemy import (
@@ -8,22 +10,53 @@ from sqlalchemy import (
     String,
     ForeignKey,
     DateTime,
+    Date,
     Boolean,
     ARRAY,
+    Index,
+    text,
 )
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import MutableList
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy.orm import sessionmaker, relationship, backref, scoped_session
 from telegram.utils.helpers import escape_markdown
 
-from app.vars import DB_URL, Emoji, MAIN_HOURS
+from app.vars import DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, Emoji, MAIN_HOURS
 
 # Connect to DB
 Base = declarative_base()
-engine = create_engine(DB_URL)
-Session = sessionmaker(bind=engine)
-session = Session()
+engine = create_engine(
+    DB_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+# Thread-local session: every dispatcher worker gets its own one.
+# It is committed and released once per update by 'bot_utils.unit_of_work',
+# so objects don't need to be reloaded after commit.
+session = scoped_session(Session)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    """Counts DB round trips made by the current update, see 'session.info["queries"]'"""
+    if session.registry.has():
+        session.info["queries"] = session.info.get("queries", 0) + 1
+
+
+def naive_utc(date_time) -> dt:
+    """DateTime columns store UTC without timezone info, keep new values the same"""
+    if date_time.tzinfo:
+        return date_time.astimezone(pytz.utc).replace(tzinfo=None)
+    return date_time
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
 
 
 class Generic:
@@ -39,17 +72,15 @@ class Generic:
 
     @staticmethod
     def save():
-        try:
-            session.commit()
-        except:
-            session.rollback()
-            raise
+        """Flush changes, commit happens once at the end of the update"""
+        session.flush()
 
 
 class Association(Base, Generic):
     """Many-to-many association table"""
 
     __tablename__ = "association"
+    __table_args__ = (Index("ix_association_player_id", "player_id"),)
     game_id = Column(Integer, ForeignKey("game.id"), primary_key=True)
     player_id = Column(Integer, ForeignKey("player.id"), primary_key=True)
     joined_at = Column(DateTime)
@@ -105,11 +136,25 @@ class Player(Base, Generic):
 
     @property
     def timezone_pytz(self):
-        return pytz.timezone(self.timezone)
+        return get_timezone(self.timezone)
 
 
 class Game(Base, Generic):
     __tablename__ = "game"
+    __table_args__ = (
+        # One active game per chat and timeslot
+        Index(
+            "uq_game_active_chat_timeslot",
+            "chat_id",
+            "timeslot",
+            unique=True,
+            postgresql_where=text("NOT expired"),
+        ),
+        Index(
+            "ix_game_active_timeslot", "timeslot", postgresql_where=text("NOT expired")
+        ),
+        Index("ix_game_chat_id", "chat_id"),
+    )
     id = Column(Integer, primary_key=True)
     timeslot = Column(DateTime)
     expired = Column(Boolean, default=False)
@@ -117,37 +162,71 @@ class Game(Base, Generic):
     chat_id = Column(BigInteger, ForeignKey("chat.id"))
 
     def add_player(self, player, joined_at):
-        self.player_game.append(
-            Association(game=self, player=player, joined_at=joined_at)
-        )
+        self.join(player, joined_at)
         self.save()
-        self.tag_everyone()
+        self.expire_roster(player)
 
     def remove_player(self, player):
-        self.players.remove(player)
+        self.leave(player)
         self.save()
+        self.expire_roster(player)
+
+    def join(self, player, joined_at):
+        """Add player to the roster in memory, it's written on next flush"""
+        # Appending sets 'Association.game', passing game=self too would add it twice
+        self.player_game.append(
+            Association(player=player, joined_at=naive_utc(joined_at))
+        )
+        self.tag_everyone()
+
+    def leave(self, player):
+        """Remove player from the roster in memory, it's written on next flush"""
+        assoc = self.get_assoc(player)
+        if assoc:
+            self.player_game.remove(assoc)
         self.tag_everyone()
 
+    def expire_roster(self, player):
+        """Reload collections that were changed through associations after flush"""
+        session.expire(self, ["players"])
+        session.expire(player, ["games", "player_game"])
+
     def tag_everyone(self):
-        """Tag all players with queue tags"""
+        """Tag all players with queue tags in memory, only changed rows get updated on flush"""
+        slots = len(self.player_game)
         for index, assoc in enumerate(self.assoc_sorted):
-            tag = ""
-            in_queue = False
-            if self.slots < 10:
-                if index >= 5:
-                    tag = "\[_queue_] "
-                    in_queue = True
+            tag, in_queue = self.queue_tag(index, slots)
+            if assoc.queue_tag != tag or assoc.in_queue != in_queue:
+                assoc.queue_tag = tag
+                assoc.in_queue = in_queue
+
+    @staticmethod
+    def queue_tag(index, slots) -> tuple:
+        """Returns queue tag and queue flag for player at given position"""
+        if slots < 10:
+            if index >= 5:
+                return "\[_queue_] ", True
+            return "", False
+        else:
+            if index < 5:
+                return "\[_1st_] ", False
+            elif 5 <= index < 10:
+                return "\[_2nd_] ", False
             else:
-                if index < 5:
-                    tag = "\[_1st_] "
-                elif 5 <= index < 10:
-                    tag = "\[_2nd_] "
-                else:
-                    tag = "\[_queue_] "
-                    in_queue = True
-            assoc.queue_tag = tag
-            assoc.in_queue = in_queue
-            assoc.save()
+                return "\[_queue_] ", True
+
+    def get_assoc(self, player):
+        """Returns association of given player from the loaded roster.
+        Associations joined since the last flush have no player_id yet."""
+        for assoc in self.player_game:
+            if assoc.player_id is None:
+                if assoc.player is player:
+                    return assoc
+            elif assoc.player_id == player.id:
+                return assoc
+
+    def has_player(self, player) -> bool:
+        return self.get_assoc(player) is not None
 
     @property
     def timeslot_utc(self) -> dt:
@@ -158,7 +237,7 @@ class Game(Base, Generic):
 
     @property
     def slots(self) -> int:
-        return len(self.players)
+        return len(self.player_game)
 
     @property
     def assoc_sorted(self) -> list:
@@ -232,8 +311,62 @@ class Chat(Base, Generic):
 
     @property
     def timezone_pytz(self):
-        return pytz.timezone(self.timezone)
+        return get_timezone(self.timezone)
 
 
-# Create tables in DB
-Base.metadata.create_all(bind=engine)
+class Reminder(Base, Generic):
+    """Scheduled game message, kept in DB so it survives restarts"""
+
+    __tablename__ = "reminder"
+    id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, ForeignKey("game.id"), index=True)
+    fire_at = Column(DateTime, index=True)
+    kind = Column(String)
+    game = relationship("Game")
+
+    @property
+    def fire_at_utc(self) -> dt:
+        return pytz.utc.localize(self.fire_at)
+
+
+class PlayerStats(Base, Generic):
+    """Games played by player in chat per day, rolled up when games expire"""
+
+    __tablename__ = "player_stats"
+    chat_id = Column(BigInteger, ForeignKey("chat.id"), primary_key=True)
+    player_id = Column(Integer, ForeignKey("player.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    games_played = Column(Integer, default=0)
+    games_queued = Column(Integer, default=0)
+    player = relationship("Player")
+
+
+class ChatStats(Base, Generic):
+    """Games played in chat per day, rolled up when games expire"""
+
+    __tablename__ = "chat_stats"
+    chat_id = Column(BigInteger, ForeignKey("chat.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    games = Column(Integer, default=0)
+
+
+def check_schema():
+    """Fails fast if DB is not migrated to the latest revision.
+    Migrations run as a release step: 'alembic upgrade head'."""
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    config = Config(os.path.join(os.path.dirname(__file__), "..", "alembic.ini"))
+    head = ScriptDirectory.from_config(config).get_current_head()
+    try:
+        with engine.connect() as connection:
+            current = connection.execute(
+                text("SELECT version_num FROM alembic_version")
+            ).scalar()
+    except ProgrammingError:
+        current = None
+    if current != head:
+        raise RuntimeError(
+            f"DB schema is at revision {current}, expected {head}. "
+            f"Run 'alembic upgrade head'."
+        )
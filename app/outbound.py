@@ -0,0 +1,149 @@
+import threading
+import time
+from functools import wraps
+from itertools import count
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from app.vars import (
+    OUTBOUND_GLOBAL_LIMIT,
+    OUTBOUND_CHAT_LIMIT,
+    OUTBOUND_MAX_RETRIES,
+)
+
+# Outbound priorities, lower is sent first
+REPLY, NOTIFICATION = range(2)
+
+# Priority of messages sent from the current thread
+local = threading.local()
+
+
+def background(func):
+    """Messages sent by decorated function (e.g. scheduled job) yield to user replies"""
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        local.priority = NOTIFICATION
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.priority = REPLY
+
+    return wrapped
+
+
+class TokenBucket:
+    """Allows {amount} messages per {period} seconds, refilled continuously"""
+
+    def __init__(self, amount, period, clock=time.monotonic):
+        self.capacity = amount
+        self.rate = amount / period
+        self.tokens = float(amount)
+        self.clock = clock
+        self.updated = clock()
+        self.paused_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now) -> float:
+        """Seconds until a token is available"""
+        self.refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = self.clock() + seconds
+
+
+class OutboundLimiter:
+    """Global and per-chat token buckets shared by all threads.
+    Waiting senders are served by priority, then in arrival order,
+    a chat that is out of tokens doesn't hold back other chats."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.global_bucket = TokenBucket(*OUTBOUND_GLOBAL_LIMIT, clock=clock)
+        self.chat_buckets = {}
+        self.waiting = []
+        self.counter = count()
+
+    def share(self, parts):
+        """Keep 1/parts of the global limit when several processes send as the same bot"""
+        amount, period = OUTBOUND_GLOBAL_LIMIT
+        with self.condition:
+            self.global_bucket = TokenBucket(amount / parts, period, clock=self.clock)
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(
+                *OUTBOUND_CHAT_LIMIT, clock=self.clock
+            )
+        return self.chat_buckets[chat_id]
+
+    def wait_time(self, chat_id, now) -> float:
+        wait = self.global_bucket.wait_time(now)
+        if chat_id is not None:
+            wait = max(wait, self.chat_bucket(chat_id).wait_time(now))
+        return wait
+
+    def acquire(self, chat_id, priority):
+        """Blocks until message to given chat may be sent"""
+        with self.condition:
+            entry = (priority, next(self.counter), chat_id)
+            self.waiting.append(entry)
+            try:
+                while True:
+                    now = self.clock()
+                    next_wait = None
+                    for waiter in sorted(self.waiting):
+                        wait = self.wait_time(waiter[2], now)
+                        if wait == 0:
+                            break
+                        next_wait = wait if next_wait is None else min(next_wait, wait)
+                    else:
+                        waiter = None
+                    if waiter == entry:
+                        self.global_bucket.take()
+                        if chat_id is not None:
+                            self.chat_bucket(chat_id).take()
+                        return
+                    self.condition.wait(timeout=1 if waiter else next_wait)
+            finally:
+                self.waiting.remove(entry)
+                self.condition.notify_all()
+
+    def pause(self, chat_id, seconds):
+        """Stop sending to chat (or everywhere) after Telegram's flood wait"""
+        with self.condition:
+            if chat_id is None:
+                self.global_bucket.pause(seconds)
+            else:
+                self.chat_bucket(chat_id).pause(seconds)
+
+
+class RateLimitedBot(ExtBot):
+    """Bot that sends and edits messages within Telegram flood limits"""
+
+    limiter = OutboundLimiter()
+
+    def _message(self, endpoint, data, *args, **kwargs):
+        chat_id = data.get("chat_id")
+        priority = getattr(local, "priority", REPLY)
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            self.limiter.acquire(chat_id, priority)
+            try:
+                return super()._message(endpoint, data, *args, **kwargs)
+            except RetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                self.limiter.pause(chat_id, e.retry_after)
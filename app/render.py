@@ -0,0 +1,210 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from app.vars import (
+    COLORS,
+    CHART_SAVE_PARAMS,
+    STICKER_SAVE_PARAMS,
+    STICKER_FONT,
+    EMOJI_FONTS,
+    RENDER_WORKERS,
+    RENDER_QUEUE_SIZE,
+    RENDER_TIMEOUT,
+)
+
+# PIL, matplotlib and emoji table are imported inside the jobs
+# to keep them out of the bot's startup.
+
+# Process pool for CPU-heavy rendering, created on first use and after a worker dies
+executor = None
+executor_lock = threading.Lock()
+# Limits jobs waiting for or running in the pool
+render_slots = threading.BoundedSemaphore(RENDER_QUEUE_SIZE)
+
+
+class RenderError(Exception):
+    """Rendering queue is full or job took too long"""
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    with executor_lock:
+        if executor is None:
+            # Spawn workers, forking would copy the bot's threads and DB connections
+            executor = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return executor
+
+
+def drop_executor(broken):
+    """Forgets broken pool, so the next job starts a new one"""
+    global executor
+    with executor_lock:
+        if executor is broken:
+            executor = None
+    broken.shutdown(wait=False)
+
+
+def render(func, *args) -> bytes:
+    """Runs render job in process pool and returns encoded image.
+    Job and its arguments must be picklable."""
+    if not render_slots.acquire(blocking=False):
+        raise RenderError("render queue is full")
+    try:
+        pool = get_executor()
+        future = pool.submit(func, *args)
+    except BrokenProcessPool:
+        render_slots.release()
+        drop_executor(pool)
+        raise RenderError("render worker died")
+    except:
+        render_slots.release()
+        raise
+    # Slot is freed only when the job really finishes, even after timeout
+    future.add_done_callback(lambda _: render_slots.release())
+    try:
+        return future.result(timeout=RENDER_TIMEOUT)
+    except TimeoutError:
+        raise RenderError(f"render took more than {RENDER_TIMEOUT}s")
+    except BrokenProcessPool:
+        drop_executor(pool)
+        raise RenderError("render worker died")
+
+
+def encode_image(save, **params) -> bytes:
+    """Encodes image with given save function in memory"""
+    buffer = io.BytesIO()
+    save(buffer, **params)
+    return buffer.getvalue()
+
+
+def get_font(size, index=0, emoji=False):
+    """Returns font parsed once per process"""
+    # Cache is keyed by call signature, so it's always called the same way
+    return load_font(size, index, emoji)
+
+
+@lru_cache(maxsize=None)
+def load_font(size, index, emoji):
+    """Emoji font falls back through EMOJI_FONTS to the first one that loads,
+    falling back to the sticker font returns the same object as the regular font"""
+    from PIL import ImageFont
+
+    if not emoji:
+        return ImageFont.truetype(font=STICKER_FONT, size=size, index=index)
+    for font_file in EMOJI_FONTS:
+        if font_file == STICKER_FONT:
+            break
+        try:
+            return ImageFont.truetype(font=font_file, size=size, index=index)
+        except OSError:
+            continue
+    return load_font(size, index, False)
+
+
+def has_emoji(text) -> bool:
+    from emoji import get_emoji_regexp
+
+    return get_emoji_regexp().search(text) is not None
+
+
+def text_runs(text) -> list:
+    """Splits text into (is_emoji, run) pairs, emoji sequences are kept whole"""
+    from emoji import get_emoji_regexp
+
+    # Pattern has one group, so emoji land on odd positions of the split
+    parts = get_emoji_regexp().split(text)
+    return [(index % 2 == 1, part) for index, part in enumerate(parts) if part]
+
+
+def draw_text(draw, xy, text, fill, font, emoji_font):
+    """Draws multiline text, emoji glyphs come from emoji font and everything else from font"""
+    if emoji_font is font or not has_emoji(text):
+        draw.text(xy=xy, text=text, fill=fill, font=font, embedded_color=True)
+        return
+    x, y = xy
+    # Same line spacing as 'ImageDraw.multiline_text'
+    line_height = font.getbbox("A")[3] + 4
+    for line in text.split("\n"):
+        offset = 0
+        for is_emoji, run in text_runs(line):
+            run_font = emoji_font if is_emoji else font
+            draw.text(
+                xy=(x + offset, y),
+                text=run,
+                fill=fill,
+                font=run_font,
+                embedded_color=True,
+            )
+            offset += draw.textlength(run, font=run_font)
+        y += line_height
+
+
+def render_games_chart(days, games) -> bytes:
+    """Bar chart of games per day"""
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(15, 6))
+    ax = fig.subplots()
+    ax.bar([str(day) for day in days], games)
+    ax.set_title("Games per day")
+    ax.set_xlabel("day")
+    ax.tick_params(axis="x", labelrotation=45)
+    fig.tight_layout()
+    return encode_image(fig.savefig, **CHART_SAVE_PARAMS)
+
+
+def sticker_height(wrapped_text, font_size=20) -> int:
+    return 80 + len(wrapped_text.split("\n")) * (font_size + 2)
+
+
+def render_sticker(full_name, wrapped_text, user_color, font_size=20) -> bytes:
+    """Image of the forwarded message"""
+    from PIL import Image, ImageDraw
+
+    img_w = 450
+    img_h = sticker_height(wrapped_text, font_size)
+    padding_l = 30
+
+    bg_params = {
+        "mode": "RGBA",
+        "size": (img_w, img_h),
+        "color": COLORS["white"],
+    }
+
+    # Create the image
+    img = Image.new(**bg_params)
+    font = get_font(font_size)
+    emoji_font = get_font(font_size, emoji=True)
+    font_bold = get_font(font_size, index=1)
+
+    r = 25
+    x = padding_l + r
+    y = 45
+    leftUpPoint = (x - r, y - r)
+    rightDownPoint = (x + r, y + r)
+
+    draw = ImageDraw.Draw(img)
+    draw.ellipse(xy=(leftUpPoint, rightDownPoint), fill=user_color)
+    draw.text(
+        xy=(padding_l + 2 * r + 20, 20),
+        text=full_name,
+        fill=user_color,
+        font=font_bold,
+        embedded_color=True,
+    )
+    draw_text(
+        draw,
+        xy=(padding_l + 2 * r + 20, 50),
+        text=wrapped_text,
+        fill=COLORS["black"],
+        font=font,
+        emoji_font=emoji_font,
+    )
+    return encode_image(img.save, **STICKER_SAVE_PARAMS)
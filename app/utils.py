@@ -1,14 +1,47 @@
 import json
 import logging
+import os
 import random
-from datetime import datetime as dt, timedelta
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime as dt, time as dt_time, timedelta
+from functools import lru_cache
 
-import pandas as pd
 import pytz
 import requests
-
-from app.models import Game, Player, session, Association, Chat
-from app.vars import Emoji, DEBUG, LEETCODE_LEVELS, COMMON_TIMEZONES
+from sqlalchemy import update, func, cast, distinct, Date
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
+
+from app.models import (
+    Game,
+    Player,
+    session,
+    Association,
+    Chat,
+    PlayerStats,
+    ChatStats,
+    Reminder,
+    naive_utc,
+)
+from app.vars import (
+    Emoji,
+    DEBUG,
+    LEETCODE_LEVELS,
+    COMMON_TIMEZONES,
+    GAME_EXPIRY,
+    LEETCODE_API_URL,
+    LEETCODE_CACHE_FILE,
+    LEETCODE_CACHE_TTL,
+)
+
+# Compact LeetCode problem catalog shared by all workers
+leetcode_problems = []
+leetcode_lock = threading.Lock()
 
 
 def row_list_chunks(lst, min_row_size=4, row_amount=2) -> list:
@@ -35,13 +68,17 @@ def sync_player_data(player: Player, user):
         player.save()
 
 
-def player_query(player_id):
-    return session.query(Player).filter_by(id=player_id).first()
+def update_cache(name) -> dict:
+    """Returns dict that lives as long as the current update's session"""
+    return session.info.setdefault(name, {})
 
 
 def get_player(update) -> Player:
-    """Returns Player model for current user"""
+    """Returns Player model for current user, resolved once per update"""
     user = update.effective_user
+    players = update_cache("players")
+    if user.id in players:
+        return players[user.id]
     player = session.query(Player).filter_by(user_id=user.id).first()
     if player:
         sync_player_data(player, user)
@@ -53,34 +90,43 @@ def get_player(update) -> Player:
             last_name=user.last_name,
         )
         player.create()
+    players[user.id] = player
     return player
 
 
-def convert_to_dt(timeslot, timezone) -> dt:
-    """Converts time into datetime object in UTC timezone"""
-    time = dt.strptime(timeslot, "%H:%M")
-    now = dt.now(tz=timezone)
+@lru_cache(maxsize=256)
+def timeslot_table(timezone, date, is_daytime) -> dict:
+    """Maps every hour to UTC datetime of its next game for given local date.
+    From 4am night hours belong to the next date, so the table changes at 4am."""
+    table = {}
+    for hour in range(24):
+        if is_daytime and hour < 4:
+            day = date + timedelta(days=1)
+        else:
+            day = date
+        timeslot = timezone.localize(dt.combine(day, dt_time(hour)))
+        table[hour] = timeslot.astimezone(pytz.utc)
+    return table
 
-    is_daytime = now.hour >= 4
-    is_night_game = time.hour < 4
 
-    if is_daytime and is_night_game:
-        day = now.date() + timedelta(days=1)
-    else:
-        day = now.date()
+def hour_to_dt(hour, timezone) -> dt:
+    """Converts hour into datetime object in UTC timezone"""
+    now = dt.now(tz=timezone)
+    return timeslot_table(timezone, now.date(), now.hour >= 4)[hour]
 
-    date_time = f"{day} {time.hour}:{time.minute}"
-    timeslot_obj = dt.strptime(date_time, "%Y-%m-%d %H:%M")
-    timeslot_localized = timezone.localize(timeslot_obj)
-    return timeslot_localized.astimezone(pytz.utc)
+
+def convert_to_dt(timeslot, timezone) -> dt:
+    """Converts time into datetime object in UTC timezone"""
+    hour, minute = (int(part) for part in timeslot.split(":"))
+    return hour_to_dt(hour, timezone) + timedelta(minutes=minute)
 
 
-def create_game(chat, timeslot) -> Game:
-    """Creates new game"""
-    game = Game(timeslot=timeslot)
-    game.create()
-    current_chat = get_chat(chat)
-    current_chat.add_game(game)
+def create_game(chat, timeslot, flush=True) -> Game:
+    """Creates new game, without flush it's written together with other changes"""
+    game = Game(timeslot=naive_utc(timeslot), chat_id=chat.id)
+    session.add(game)
+    if flush:
+        game.save()
     return game
 
 
@@ -94,6 +140,10 @@ def sync_chat_data(current_chat: Chat, chat):
 
 
 def get_chat(chat):
+    """Returns Chat model for given Telegram chat, resolved once per update"""
+    chats = update_cache("chats")
+    if chat.id in chats:
+        return chats[chat.id]
     current_chat = session.query(Chat).filter_by(id=chat.id).first()
     if current_chat:
         sync_chat_data(current_chat, chat)
@@ -104,6 +154,7 @@ def get_chat(chat):
             title=chat.title,
         )
         current_chat.create()
+    chats[chat.id] = current_chat
     return current_chat
 
 
@@ -115,32 +166,162 @@ def game_timediff(game: Game, hours=0, minutes=0) -> bool:
     return now - timeslot > delta
 
 
+def active_games(chat_id):
+    """Query for not expired games of given chat.
+    Games past the expiry time are filtered out even before the sweeper marks them."""
+    return session.query(Game).filter(
+        Game.chat_id == chat_id,
+        Game.expired == False,
+        Game.timeslot >= dt.utcnow() - GAME_EXPIRY,
+    )
+
+
+def in_shard(chat_id, shard):
+    """SQL condition selecting chats of (index, shards) worker, see 'webhook.shard_of'"""
+    index, shards = shard
+    return func.abs(chat_id) % shards == index
+
+
+def expire_games(shard=None) -> list:
+    """Marks outdated games (of given shard) as expired with a single UPDATE and rolls up their stats.
+    Returns (game id, chat id) pairs of expired games."""
+    conditions = [Game.expired == False, Game.timeslot < dt.utcnow() - GAME_EXPIRY]
+    if shard:
+        conditions.append(in_shard(Game.chat_id, shard))
+    expired = session.execute(
+        update(Game)
+        .where(*conditions)
+        .values(expired=True)
+        .returning(Game.id, Game.chat_id)
+        # Shard condition can't be evaluated in Python, sweeps run in their own session
+        .execution_options(synchronize_session=False)
+    ).all()
+    if expired:
+        rollup_stats([game_id for game_id, _ in expired])
+    return expired
+
+
+def upsert_counters(model, rows, keys):
+    """Inserts rows or adds their counters to already existing ones"""
+    stmt = insert(model).values(rows)
+    counters = [column for column in rows[0] if column not in keys]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            column: getattr(model, column) + stmt.excluded[column]
+            for column in counters
+        },
+    )
+    session.execute(stmt)
+
+
+def rollup_stats(game_ids):
+    """Adds given expired games to statistics.
+    Games expired before statistics existed are filled in by migration 0002."""
+    day = cast(Game.timeslot, Date)
+    player_rows = (
+        session.query(
+            Game.chat_id,
+            Association.player_id,
+            day,
+            func.count().filter(Association.in_queue == False),
+            func.count().filter(Association.in_queue == True),
+        )
+        .join(Association, Association.game_id == Game.id)
+        .filter(Game.expired == True, Game.id.in_(game_ids))
+        .group_by(Game.chat_id, Association.player_id, day)
+    )
+    chat_rows = (
+        session.query(Game.chat_id, day, func.count(distinct(Game.id)))
+        .join(Association, Association.game_id == Game.id)
+        .filter(
+            Game.expired == True,
+            Game.id.in_(game_ids),
+            Association.in_queue == False,
+        )
+        .group_by(Game.chat_id, day)
+    )
+
+    player_stats = [
+        dict(chat_id=c, player_id=p, day=d, games_played=played, games_queued=queued)
+        for c, p, d, played, queued in player_rows
+    ]
+    chat_stats = [dict(chat_id=c, day=d, games=games) for c, d, games in chat_rows]
+    if player_stats:
+        upsert_counters(PlayerStats, player_stats, keys=["chat_id", "player_id", "day"])
+    if chat_stats:
+        upsert_counters(ChatStats, chat_stats, keys=["chat_id", "day"])
+
+
 def get_game(chat_id, game_id=None, timeslot=None) -> Game:
     """Returns Game model for current chat"""
     if game_id:
-        return (
-            session.query(Game)
-            .filter_by(id=game_id, chat_id=chat_id, expired=False)
-            .first()
-        )
+        return active_games(chat_id).filter(Game.id == game_id).first()
     elif timeslot:
-        return (
-            session.query(Game)
-            .filter_by(timeslot=timeslot, chat_id=chat_id, expired=False)
-            .first()
-        )
+        return active_games(chat_id).filter(Game.timeslot == timeslot).first()
+
 
+def get_reminder(reminder_id) -> Reminder:
+    return session.query(Reminder).filter_by(id=reminder_id).first()
 
-def get_all_data(chat_id):
-    """Returns all data for current chat in form of Pandas DataFrame"""
+
+def get_upcoming_reminders(shard=None) -> list:
+    """Returns reminders of active games (of given shard) that are still to be sent"""
     query = (
-        session.query(Association, Player, Game)
-        .join(Player)
+        session.query(Reminder)
         .join(Game)
-        .filter(Game.chat_id == chat_id)
+        .filter(Reminder.fire_at > dt.utcnow(), Game.expired == False)
+    )
+    if shard:
+        query = query.filter(in_shard(Game.chat_id, shard))
+    return query.order_by(Reminder.fire_at).all()
+
+
+def delete_reminders(game_id=None, shard=None):
+    """Deletes reminders of given game, or missed ones of all games (of given shard) if none given"""
+    query = session.query(Reminder)
+    if game_id:
+        query = query.filter(Reminder.game_id == game_id)
+    else:
+        query = query.filter(Reminder.fire_at <= dt.utcnow())
+        if shard:
+            games = session.query(Game.id).filter(in_shard(Game.chat_id, shard))
+            query = query.filter(Reminder.game_id.in_(games.scalar_subquery()))
+    query.delete(synchronize_session=False)
+
+
+def get_stats_data(chat_id):
+    """Returns rolled up statistics for current chat in form of Pandas DataFrames"""
+    import pandas as pd
+
+    player_name = func.coalesce(
+        func.nullif(Player.csgo_nickname, ""),
+        func.nullif(Player.username, ""),
+        Player.first_name,
+    )
+    games_played = func.sum(PlayerStats.games_played)
+    players_query = (
+        session.query(
+            player_name.label("player"),
+            games_played.label("games_played"),
+            func.sum(PlayerStats.games_queued).label("games_queued"),
+        )
+        .join(Player, Player.id == PlayerStats.player_id)
+        .filter(PlayerStats.chat_id == chat_id)
+        .group_by(Player.id)
+        .order_by(games_played.desc())
         .statement
     )
-    return pd.read_sql(query, session.bind)
+    days_query = (
+        session.query(ChatStats.day, ChatStats.games)
+        .filter_by(chat_id=chat_id)
+        .order_by(ChatStats.day)
+        .statement
+    )
+    return (
+        pd.read_sql(players_query, session.bind),
+        pd.read_sql(days_query, session.bind, index_col="day"),
+    )
 
 
 def get_assoc(game_id, player_id) -> Association:
@@ -152,18 +333,22 @@ def get_assoc(game_id, player_id) -> Association:
     )
 
 
-def get_all_games(update, ts_only=False) -> list:
-    """Returns all Game objects for current chat"""
-    games = (
-        session.query(Game)
-        .filter_by(chat_id=update.effective_chat.id, expired=False)
-        .order_by(Game.timeslot)
-        .all()
-    )
+def get_all_games(update, ts_only=False, roster=False) -> list:
+    """Returns all Game objects for current chat.
+    With roster=True associations and players are loaded upfront for rendering."""
     if ts_only:
-        return [game.timeslot_utc for game in games]
-    else:
-        return games
+        timeslots = (
+            active_games(update.effective_chat.id)
+            .with_entities(Game.timeslot)
+            .order_by(Game.timeslot)
+        )
+        return [pytz.utc.localize(timeslot) for timeslot, in timeslots]
+    query = active_games(update.effective_chat.id).order_by(Game.timeslot)
+    if roster:
+        query = query.options(
+            selectinload(Game.player_game).joinedload(Association.player)
+        )
+    return query.all()
 
 
 def get_all_players_in_games(update) -> list:
@@ -237,6 +422,22 @@ def is_dayoff(chat) -> bool:
         return is_off and is_daytime
 
 
+def import_costs(limit=15) -> list:
+    """Returns slowest imports of the bot measured in a fresh interpreter, in ms"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.bot"],
+        capture_output=True,
+        text=True,
+    )
+    costs = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        costs.append((int(cumulative) / 1000, module.rstrip()))
+    return sorted(costs, reverse=True)[:limit]
+
+
 def logger() -> logging.Logger:
     """Enables logging"""
     logging.basicConfig(
@@ -258,26 +459,116 @@ def chop(word, upper=False):
     return result
 
 
-def get_leetcode_problem() -> str:
-    """Returns url to random leetcode problem"""
+# "/in" and "/out" with any prefix of them, e.g. "i" -> "in", "ou" -> "out"
+IN_OUT_ALIASES = {alias: action for action in ["in", "out"] for alias in chop(action)}
+HOURS_PATTERN = re.compile("^([0-9]+)(?:-([0-9]+))?$")
+
+InOut = namedtuple("InOut", ["action", "hours"])
+
+
+def parse_in_out(text, main_hours):
+    """
+    Parses join/leave commands into a plan, hours follow main hours order.
+    example:
+        "/in 18-20 23 /o 22-1" =>> [InOut("in", [18, 19, 20, 23]), InOut("out", [22, 23, 0, 1])]
+    Hours not in main hours are skipped, "all" gives hours=None.
+    Returns None if some command has no arguments.
+    """
+    indexes = {hour: index for index, hour in enumerate(main_hours)}
+    plan = []
+    for line in text.split("/"):
+        words = line.split()
+        if not words:
+            continue
+        command, args = words[0].split("@")[0].lower(), words[1:]
+        if not args:
+            return None
+        action = IN_OUT_ALIASES.get(command)
+        if not action:
+            continue
+        if args[0].lower() == "all":
+            plan.append(InOut(action, None))
+            continue
+        hours = set()
+        for arg in args:
+            match = HOURS_PATTERN.match(arg)
+            if not match:
+                continue
+            first, last = match.groups()
+            first_index = indexes.get(int(first))
+            last_index = indexes.get(int(last)) if last else first_index
+            if first_index is not None and last_index is not None:
+                hours.update(main_hours[first_index : last_index + 1])
+        plan.append(InOut(action, sorted(hours, key=indexes.get)))
+    return plan
+
+
+def fetch_leetcode_problems() -> list:
+    """Downloads LeetCode catalog and keeps only free problems with fields we need"""
     response = requests.get(
-        url="https://leetcode.com/api/problems/all/",
+        url=LEETCODE_API_URL,
         headers={"User-Agent": "Python", "Connection": "keep-alive"},
         timeout=10,
     )
+    response.raise_for_status()
     data = json.loads(response.content.decode("utf-8"))
-    all_problems = [
-        problem
+    return [
+        {
+            "slug": problem["stat"]["question__title_slug"],
+            "level": problem["difficulty"]["level"],
+            "submitted": problem["stat"]["total_submitted"],
+            "accepted": problem["stat"]["total_acs"],
+        }
         for problem in data["stat_status_pairs"]
         if not problem["paid_only"] and not problem["stat"]["question__hide"]
     ]
-    random_problem = random.choice(all_problems)
-    difficulty = LEETCODE_LEVELS[random_problem["difficulty"]["level"]]
-    title_slug = random_problem["stat"]["question__title_slug"]
-    url = f"https://leetcode.com/problems/{title_slug}"
-    submitted = random_problem["stat"]["total_submitted"]
-    accepted = random_problem["stat"]["total_acs"]
-    acceptance_rate = round(accepted / submitted * 100, 1)
+
+
+def load_leetcode_problems() -> float:
+    """Loads cached catalog from disk, used on startup before the first refresh.
+    Returns seconds until the cached copy is due for refresh."""
+    global leetcode_problems
+    try:
+        with open(LEETCODE_CACHE_FILE) as cache_file:
+            problems = json.load(cache_file)
+        age = time.time() - os.path.getmtime(LEETCODE_CACHE_FILE)
+    except (OSError, ValueError):
+        return 0
+    with leetcode_lock:
+        if not leetcode_problems:
+            leetcode_problems = problems
+    return max(0, LEETCODE_CACHE_TTL - age)
+
+
+def refresh_leetcode_problems(context=None):
+    """Refreshes cached catalog in memory and on disk. Keeps stale copy on failure."""
+    global leetcode_problems
+    try:
+        problems = fetch_leetcode_problems()
+    except Exception as e:
+        logger().warning(f"LeetCode catalog refresh failed: {e}")
+        return
+    if not problems:
+        return
+    with leetcode_lock:
+        leetcode_problems = problems
+    try:
+        os.makedirs(os.path.dirname(LEETCODE_CACHE_FILE) or ".", exist_ok=True)
+        with open(LEETCODE_CACHE_FILE, "w") as cache_file:
+            json.dump(problems, cache_file)
+    except OSError as e:
+        logger().warning(f"LeetCode catalog was not saved: {e}")
+
+
+def get_leetcode_problem() -> str:
+    """Returns url to random leetcode problem from cached catalog"""
+    if not leetcode_problems:
+        raise LookupError("LeetCode catalog is not loaded yet")
+    random_problem = random.choice(leetcode_problems)
+    difficulty = LEETCODE_LEVELS[random_problem["level"]]
+    url = f"https://leetcode.com/problems/{random_problem['slug']}"
+    submitted = random_problem["submitted"] or 1
+    acceptance_rate = round(random_problem["accepted"] / submitted * 100, 1)
     if acceptance_rate < 40:
         reaction = Emoji.scream
     elif acceptance_rate < 70:
@@ -1,8 +1,7 @@
 import json
 import os
 from dataclasses import dataclass
-
-from emoji import emojize
+from datetime import timedelta
 
 COLORS = {
     "black": (0, 0, 0, 255),
@@ -14,26 +13,44 @@ USERNAME_COLORS = {
     "purple": (100, 0, 200, 255),
 }
 
+# Image encoding options, Telegram downscales photos to 1280px anyway
+CHART_SAVE_PARAMS = {"format": "png", "dpi": 100}
+STICKER_SAVE_PARAMS = {"format": "png", "optimize": True}
+
+# Fonts, emoji glyphs are looked up in the listed order
+STICKER_FONT = "./.fonts/LucidaGrande.ttc"
+EMOJI_FONTS = ["./.fonts/Apple Color Emoji.ttc", STICKER_FONT]
+
+# Telegram flood limits: (messages, per seconds)
+OUTBOUND_GLOBAL_LIMIT = (30, 1)
+OUTBOUND_CHAT_LIMIT = (20, 60)
+OUTBOUND_MAX_RETRIES = 3
+
+# Rendering process pool: workers, max jobs in flight and job timeout in seconds
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "1"))
+RENDER_QUEUE_SIZE = 4
+RENDER_TIMEOUT = 30
+
 # Stickers
 STICKERS = {
     "hahaclassic": "CAACAgIAAxkBAAL1al7t3M55gfj6YTVuJuETd2ZttQY0AAL6AANWnb0KR976l3F0cQEaBA",
 }
 
 
-# Emoji
+# Emoji, literal characters keep the emoji table out of startup
 @dataclass
 class Emoji:
-    gun = emojize(":gun:", use_aliases=True)
-    fire = emojize(":fire:", use_aliases=True)
-    zzz = emojize(":zzz:", use_aliases=True)
-    party = emojize(":party_popper:", use_aliases=True)
-    dizzy = emojize(":dizzy_face:", use_aliases=True)
-    clock = emojize(":alarm_clock:", use_aliases=True)
-    check = emojize(":white_check_mark:", use_aliases=True)
-    cross = emojize(":cross_mark:", use_aliases=True)
-    scream = emojize(":scream:", use_aliases=True)
-    suprise = emojize(":open_mouth:", use_aliases=True)
-    thumbsup = emojize(":thumbsup:", use_aliases=True)
+    gun = "🔫"
+    fire = "🔥"
+    zzz = "💤"
+    party = "🎉"
+    dizzy = "😵"
+    clock = "⏰"
+    check = "✅"
+    cross = "❌"
+    scream = "😱"
+    suprise = "😮"
+    thumbsup = "👍"
 
 
 LEETCODE_LEVELS = {
@@ -41,6 +58,14 @@ LEETCODE_LEVELS = {
     2: "medium",
     3: "hard",
 }
+LEETCODE_API_URL = os.environ.get(
+    "LEETCODE_API_URL", "https://leetcode.com/api/problems/all/"
+)
+LEETCODE_CACHE_FILE = os.environ.get(
+    "LEETCODE_CACHE_FILE", "./.cache/leetcode_problems.json"
+)
+# How often problem catalog is refreshed, in seconds
+LEETCODE_CACHE_TTL = 24 * 60 * 60
 
 USAGE_TEXT = """\
 ```
@@ -83,6 +108,19 @@ COMMANDS = [
     ("out", "leave with argumnets"),
 ]
 
+# Games are expired this long after their timeslot
+GAME_EXPIRY = timedelta(hours=1)
+# How often expired games are swept, in seconds
+EXPIRY_SWEEP_INTERVAL = 60
+
+# Main page edits within this many seconds are merged into one
+MAIN_PAGE_EDIT_DELAY = 0.5
+
+# Game reminders: kind -> (time before the game, message)
+REMINDERS = {
+    "start": (timedelta(minutes=5), "game starts in 5 mins!"),
+}
+
 MAIN_HOURS = [18, 19, 20, 21, 22, 23, 0, 1]
 EXTENDED_HOURS = [14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 0, 1, 2, 3]
 
@@ -100,12 +138,20 @@ MAIN_STATE, SECONDARY_STATE = range(2)
 # Patterns
 HOUR_MINUTE_PATTERN = "^(0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]$"
 
+# Time from process start until bot is ready, checked by '--profile-startup'
+STARTUP_BUDGET = 5
+
 # App variables
 APP_URL = os.getenv("APP_URL")
 HOST = "0.0.0.0"
 PORT = int(os.environ.get("PORT", "8443"))
 TOKEN = os.getenv("TOKEN")
 DB_URL = os.getenv("DATABASE_URL").replace("postgres://", "postgresql://")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+WORKERS = int(os.environ.get("WORKERS", "4"))
+# Worker processes behind the webhook receiver, updates are routed by chat
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "1"))
 SENTRY_DSN = os.getenv("SENTRY_DSN")
 ALLOWED_CHATS_INTERNAL = json.loads(os.getenv("ALLOWED_CHATS_INTERNAL"))
 ALLOWED_CHATS_EXTERNAL = json.loads(os.getenv("ALLOWED_CHATS_EXTERNAL"))
@@ -0,0 +1,98 @@
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def shard_of(chat_id, shards) -> int:
+    """Index of the worker process serving given chat"""
+    return abs(chat_id) % shards
+
+
+def update_chat_id(data) -> int:
+    """Chat id of raw update, sender id for updates outside of chats (e.g. inline queries)"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        message = value.get("message", value)
+        if isinstance(message, dict) and "chat" in message:
+            return message["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Keep-alive, Telegram reuses connections
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            chat_id = update_chat_id(json.loads(body))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.send_error(400)
+            return
+        queues = self.server.queues
+        queues[shard_of(chat_id, len(queues))].put(body)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ShardedWebhook(ThreadingHTTPServer):
+    """Receives Telegram webhook and routes raw updates to worker queues by chat,
+    so every chat is served by one process in the order its updates arrive"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, url_path, queues):
+        super().__init__(address, WebhookHandler)
+        self.url_path = "/" + url_path
+        self.queues = queues
+
+    def serve_until_stopped(self):
+        """Serves until SIGTERM or SIGINT, then tells workers to finish their queues"""
+
+        def stop(signum, frame):
+            # 'shutdown' waits for 'serve_forever' to return, so it can't run here
+            threading.Thread(target=self.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            for queue in self.queues:
+                queue.put(None)
+
+
+def feed_dispatcher(updater, queue):
+    """Runs dispatcher and job queue of a worker process on updates from its queue"""
+    from telegram import Update
+
+    # Receiver stops the workers with a None in the queue, after the last update
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    dp = updater.dispatcher
+    updater.job_queue.start()
+    thread = threading.Thread(target=dp.start, name="dispatcher")
+    thread.start()
+    try:
+        for body in iter(queue.get, None):
+            dp.update_queue.put(Update.de_json(json.loads(body), updater.bot))
+    finally:
+        # Dispatcher drops queued updates on stop
+        while not dp.update_queue.empty():
+            time.sleep(0.1)
+        updater.stop()
+        thread.join()
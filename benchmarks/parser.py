@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.9
+"""
+Benchmarks /in and /out parsing against the line-by-line parsing it replaced.
+
+usage:
+    python3 benchmarks/parser.py
+
+Runs the USAGE_TEXT examples and random messages through both parsers,
+checks that they pick the same hours and prints parses per second.
+The old parser ignored '@botname' commands and one-hour ranges like '20-20',
+random messages avoid both.
+"""
+import argparse
+import os
+import random
+import re
+import time
+
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/chettam_bench")
+os.environ.setdefault("ALLOWED_CHATS_INTERNAL", "[]")
+os.environ.setdefault("ALLOWED_CHATS_EXTERNAL", "[]")
+
+from app.utils import chop, parse_in_out
+from app.vars import MAIN_HOURS, USAGE_TEXT
+
+
+def expand_hours(main_hours, hours_list):
+    """Old 'bot_utils.expand_hours'"""
+    result = []
+    for hour in hours_list:
+        if re.search("^[0-9]+-[0-9]+$", hour):
+            hour_pair = hour.split("-")
+            hours_indexes = {hour: idx for idx, hour in enumerate(main_hours)}
+            first_hour = int(hour_pair[0])
+            first_hour_index = hours_indexes.get(first_hour)
+            last_hour = int(hour_pair[1])
+            last_hour_index = hours_indexes.get(last_hour)
+            if (
+                first_hour in main_hours
+                and last_hour in main_hours
+                and first_hour_index < last_hour_index
+            ):
+                result.extend(main_hours[first_hour_index : last_hour_index + 1])
+        else:
+            if int(hour) in main_hours:
+                result.append(int(hour))
+    return set(result)
+
+
+def old_parse_in_out(text, main_hours):
+    """Old 'slot_in_out' and 'in_out' parsing, returns the same shape as 'parse_in_out'"""
+    plan = []
+    for line in [line for line in text.split("/") if line != ""]:
+        command = line.split()[0].lower()
+        args = line.split()[1:]
+        if not args:
+            return None
+        action = (
+            "in" if command in chop("in") else "out" if command in chop("out") else None
+        )
+        if not action:
+            continue
+        if args[0].lower() == "all":
+            plan.append((action, None))
+            continue
+        hours = expand_hours(
+            main_hours,
+            [
+                arg
+                for arg in args
+                if re.search("^[0-9]+-[0-9]+$", arg) or re.search("^[0-9]+$", arg)
+            ],
+        )
+        plan.append((action, hours))
+    return plan
+
+
+def as_sets(plan):
+    if plan is None:
+        return None
+    return [(action, None if hours is None else set(hours)) for action, hours in plan]
+
+
+def random_message(rng) -> str:
+    """Messages within the grammar both parsers share"""
+    commands = ["/in", "/i", "/o", "/ou", "/out", "/status"]
+    parts = []
+    for _ in range(rng.randint(1, 3)):
+        args = []
+        for _ in range(rng.randint(1, 5)):
+            first, last = rng.choice(MAIN_HOURS), rng.choice(MAIN_HOURS)
+            args.append(
+                rng.choice(
+                    [str(first), f"{first}-{last}", str(rng.randint(0, 30)), "abc"]
+                )
+            )
+        if rng.random() < 0.05:
+            args = ["all"]
+        args = [arg for arg in args if not re.match(r"^(\d+)-\1$", arg)] or ["18"]
+        parts.append(" ".join([rng.choice(commands)] + args))
+    return " ".join(parts)
+
+
+def benchmark(name, parse, messages, runs) -> float:
+    started = time.perf_counter()
+    for _ in range(runs):
+        for message in messages:
+            parse(message, MAIN_HOURS)
+    rate = runs * len(messages) / (time.perf_counter() - started)
+    print(f"{name:>16}: {rate:12.0f} parses/s")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    examples = [
+        line.strip()
+        for line in USAGE_TEXT.splitlines()
+        if "/" in line and "<" not in line
+    ]
+    rng = random.Random(args.seed)
+    messages = examples + [random_message(rng) for _ in range(args.messages)]
+    for message in messages:
+        old = old_parse_in_out(message, MAIN_HOURS)
+        new = parse_in_out(message, MAIN_HOURS)
+        assert as_sets(old) == as_sets(new), (message, old, new)
+    print(f"{len(messages)} messages parsed the same by both parsers")
+
+    old_rate = benchmark("old parser", old_parse_in_out, messages, args.runs)
+    new_rate = benchmark("parse_in_out", parse_in_out, messages, args.runs)
+    print(f"speedup: {new_rate / old_rate:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3.9
+"""
+Seeds synthetic game history into a local Postgres and reports latency and
+query plans of the DB helpers used on every update.
+
+usage:
+    export DATABASE_URL=postgresql://localhost/chettam_bench
+    alembic upgrade head
+    python3 benchmarks/queries.py
+
+Compare plans with and without indexes by running it after
+'alembic downgrade 0002' and again after 'alembic upgrade head'.
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import datetime as dt, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault("ALLOWED_CHATS_INTERNAL", "[]")
+os.environ.setdefault("ALLOWED_CHATS_EXTERNAL", "[]")
+
+from sqlalchemy import event, insert, text
+
+from app.models import engine, session, Chat, Player, Game, Association
+from app.utils import (
+    get_all_games,
+    get_game,
+    get_all_players_in_games,
+    get_assoc,
+    get_upcoming_reminders,
+    expire_games,
+)
+from app.vars import MAIN_HOURS
+
+
+def seed(chats, players, days):
+    """Inserts {days} of history with a game per main hour for every chat"""
+    now = dt.utcnow().replace(minute=0, second=0, microsecond=0)
+    player_ids = list(range(1, chats * players + 1))
+    session.execute(
+        insert(Chat),
+        [
+            dict(id=-chat_id, title=f"bench {chat_id}")
+            for chat_id in range(1, chats + 1)
+        ],
+    )
+    session.execute(
+        insert(Player),
+        [dict(id=i, user_id=i, first_name=f"player {i}") for i in player_ids],
+    )
+    game_id = 0
+    for day in range(days, -1, -1):
+        games, assocs = [], []
+        for chat_id in range(1, chats + 1):
+            chat_players = player_ids[(chat_id - 1) * players : chat_id * players]
+            for hour in MAIN_HOURS:
+                game_id += 1
+                timeslot = now - timedelta(days=day) + timedelta(hours=hour - now.hour)
+                games.append(
+                    dict(
+                        id=game_id, chat_id=-chat_id, timeslot=timeslot, expired=day > 0
+                    )
+                )
+                for index, player_id in enumerate(
+                    random.sample(chat_players, random.randint(1, len(chat_players)))
+                ):
+                    assocs.append(
+                        dict(
+                            game_id=game_id,
+                            player_id=player_id,
+                            joined_at=timeslot - timedelta(hours=1),
+                            in_queue=index >= 5,
+                        )
+                    )
+        session.execute(insert(Game), games)
+        session.execute(insert(Association), assocs)
+    session.execute(text("SELECT setval('game_id_seq', (SELECT max(id) FROM game))"))
+    session.execute(
+        text("SELECT setval('player_id_seq', (SELECT max(id) FROM player))")
+    )
+    session.commit()
+    session.execute(text("ANALYZE"))
+    session.commit()
+
+
+def capture_statements(func):
+    """Runs func and returns SQL statements it issued"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        func()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    return statements
+
+
+def benchmark(name, func, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+        session.rollback()
+    print(f"\n=== {name}")
+    print(
+        f"median {statistics.median(timings):.2f} ms, "
+        f"max {max(timings):.2f} ms over {runs} runs"
+    )
+    for statement, parameters in capture_statements(func):
+        plan = session.connection().exec_driver_sql(
+            f"EXPLAIN ANALYZE {statement}", parameters
+        )
+        print("\n".join(row[0] for row in plan))
+    session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--players", type=int, default=12)
+    parser.add_argument("--days", type=int, default=1500)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    if engine.url.host not in ("localhost", "127.0.0.1"):
+        raise SystemExit(f"Refusing to seed non-local database {engine.url.host}")
+
+    if not session.query(Game).filter(Game.chat_id == -1).first():
+        print("Seeding...")
+        seed(args.chats, args.players, args.days)
+
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=-1))
+    game = session.query(Game).filter_by(chat_id=-1, expired=False).first()
+    game_id, timeslot = game.id, game.timeslot_utc
+    session.rollback()
+    benchmark("get_all_games", lambda: get_all_games(update), args.runs)
+    benchmark(
+        "get_all_games(roster)", lambda: get_all_games(update, roster=True), args.runs
+    )
+    benchmark(
+        "get_game(timeslot)",
+        lambda: get_game(-1, timeslot=timeslot),
+        args.runs,
+    )
+    benchmark("get_assoc", lambda: get_assoc(game_id, 1), args.runs)
+    benchmark(
+        "get_all_players_in_games", lambda: get_all_players_in_games(update), args.runs
+    )
+    benchmark("get_upcoming_reminders", get_upcoming_reminders, args.runs)
+    benchmark("expire_games", expire_games, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3.9
+"""
+Benchmarks sticker rendering with fonts parsed on every render against fonts parsed once per process.
+
+usage:
+    python3 benchmarks/sticker.py --emoji-font "./.fonts/Apple Color Emoji.ttc"
+
+Run it from the repository root, font paths in 'vars' are relative to it.
+Renders run in this process, without the render pool, so only rendering is measured.
+Every render used to load the sticker font from disk twice, that's what 'uncached' does.
+"""
+import argparse
+import os
+import time
+
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/chettam_bench")
+os.environ.setdefault("ALLOWED_CHATS_INTERNAL", "[]")
+os.environ.setdefault("ALLOWED_CHATS_EXTERNAL", "[]")
+
+from app import render
+from app.vars import COLORS
+
+TEXTS = {
+    "plain": "who is in for tonight?\nI can play at 20\nand maybe at 21 too",
+    "emoji": "who is in for tonight? 🔥\nI can play at 20 👍🏽\nand maybe at 21 too 🎮🎮",
+}
+
+
+def uncached_render(*args) -> bytes:
+    render.load_font.cache_clear()
+    return render.render_sticker(*args)
+
+
+def benchmark(name, func, text, runs) -> float:
+    func("bench", text, COLORS["black"])
+    started = time.perf_counter()
+    for _ in range(runs):
+        func("bench", text, COLORS["black"])
+    rate = runs / (time.perf_counter() - started)
+    print(f"{name:>16}: {rate:8.1f} renders/s")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument(
+        "--emoji-font", help="font file tried before EMOJI_FONTS for emoji glyphs"
+    )
+    args = parser.parse_args()
+    if args.emoji_font:
+        render.EMOJI_FONTS = [args.emoji_font] + render.EMOJI_FONTS
+
+    for kind, text in TEXTS.items():
+        print(f"{kind} text:")
+        old_rate = benchmark("uncached fonts", uncached_render, text, args.runs)
+        new_rate = benchmark("get_font", render.render_sticker, text, args.runs)
+        print(f"speedup: {new_rate / old_rate:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
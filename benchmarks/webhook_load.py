@@ -0,0 +1,129 @@
+#!/usr/bin/env python3.9
+"""
+Load test of the sharded webhook: posts synthetic updates of many chats to
+'ShardedWebhook' and measures throughput with a growing number of worker processes.
+
+usage:
+    python3 benchmarks/webhook_load.py --workers 1 2 4
+
+Workers burn CPU for '--handler-ms' per update instead of running real handlers,
+so no Telegram or DB is needed. Every worker also checks that updates of each
+of its chats arrive in the order they were sent.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.webhook import ShardedWebhook, shard_of
+
+URL_PATH = "bench-token"
+
+
+def burn(seconds):
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        pass
+
+
+def worker(index, shards, queue, results, handler_ms):
+    """Stands in for 'bot.run_shard'"""
+    last_seen, handled, out_of_order = {}, 0, 0
+    for body in iter(queue.get, None):
+        message = json.loads(body)["message"]
+        chat_id, seq = message["chat"]["id"], message["message_id"]
+        if shard_of(chat_id, shards) != index or seq <= last_seen.get(chat_id, -1):
+            out_of_order += 1
+        last_seen[chat_id] = seq
+        burn(handler_ms / 1000)
+        handled += 1
+    results.put((handled, out_of_order))
+
+
+def update_body(update_id, chat_id, seq) -> bytes:
+    return json.dumps(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": seq,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "group"},
+                "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+                "text": "/status",
+            },
+        }
+    ).encode()
+
+
+def post_chat(port, chat_id, updates):
+    """Posts updates of one chat in order, like Telegram does"""
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for seq in range(updates):
+        conn.request("POST", "/" + URL_PATH, body=update_body(seq, chat_id, seq))
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+    conn.close()
+
+
+def run(shards, chats, updates, handler_ms) -> float:
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(shards)]
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(index, shards, queue, results, handler_ms))
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    server = ShardedWebhook(("127.0.0.1", 0), URL_PATH, queues)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        futures = [
+            pool.submit(post_chat, port, chat_id, updates)
+            for chat_id in range(-chats, 0)
+        ]
+    for future in futures:
+        future.result()
+    server.shutdown()
+    server.server_close()
+    for queue in queues:
+        queue.put(None)
+    totals = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    handled = sum(handled for handled, _ in totals)
+    out_of_order = sum(out_of_order for _, out_of_order in totals)
+    assert handled == chats * updates, f"lost {chats * updates - handled} updates"
+    assert not out_of_order, f"{out_of_order} updates out of order"
+    return handled / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--updates", type=int, default=50)
+    parser.add_argument("--handler-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    baseline = None
+    for shards in args.workers:
+        throughput = run(shards, args.chats, args.updates, args.handler_ms)
+        baseline = baseline or throughput
+        print(
+            f"{shards} workers: {throughput:8.1f} updates/s "
+            f"({throughput / baseline:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Initial schema, as created by 'create_all' before migrations
+
+Existing databases created by 'create_all' already have it:
+mark them with 'alembic stamp 0001' instead of upgrading.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "chat",
+        sa.Column("id", sa.BigInteger(), primary_key=True),
+        sa.Column("chat_type", sa.String()),
+        sa.Column("title", sa.String()),
+        sa.Column("timezone", sa.String()),
+        sa.Column("days_off", postgresql.ARRAY(sa.String())),
+        sa.Column("main_hours", postgresql.ARRAY(sa.Integer())),
+    )
+    op.create_table(
+        "player",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.BigInteger(), unique=True),
+        sa.Column("username", sa.String(), nullable=True),
+        sa.Column("first_name", sa.String()),
+        sa.Column("last_name", sa.String(), nullable=True),
+        sa.Column("csgo_nickname", sa.String(), nullable=True),
+        sa.Column("timezone", sa.String()),
+    )
+    op.create_table(
+        "game",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("timeslot", sa.DateTime()),
+        sa.Column("expired", sa.Boolean()),
+        sa.Column("chat_id", sa.BigInteger(), sa.ForeignKey("chat.id")),
+    )
+    op.create_table(
+        "association",
+        sa.Column("game_id", sa.Integer(), sa.ForeignKey("game.id"), primary_key=True),
+        sa.Column(
+            "player_id", sa.Integer(), sa.ForeignKey("player.id"), primary_key=True
+        ),
+        sa.Column("joined_at", sa.DateTime()),
+        sa.Column("in_queue", sa.Boolean()),
+        sa.Column("queue_tag", sa.String()),
+    )
+
+
+def downgrade():
+    for table in [
+        "association",
+        "game",
+        "player",
+        "chat",
+    ]:
+        op.drop_table(table)
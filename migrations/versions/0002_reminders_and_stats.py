@@ -0,0 +1,70 @@
+"""Reminders and statistics tables
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "reminder",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("game_id", sa.Integer(), sa.ForeignKey("game.id")),
+        sa.Column("fire_at", sa.DateTime()),
+        sa.Column("kind", sa.String()),
+    )
+    op.create_index("ix_reminder_fire_at", "reminder", ["fire_at"])
+    op.create_table(
+        "player_stats",
+        sa.Column(
+            "chat_id", sa.BigInteger(), sa.ForeignKey("chat.id"), primary_key=True
+        ),
+        sa.Column(
+            "player_id", sa.Integer(), sa.ForeignKey("player.id"), primary_key=True
+        ),
+        sa.Column("day", sa.Date(), primary_key=True),
+        sa.Column("games_played", sa.Integer()),
+        sa.Column("games_queued", sa.Integer()),
+    )
+    op.create_table(
+        "chat_stats",
+        sa.Column(
+            "chat_id", sa.BigInteger(), sa.ForeignKey("chat.id"), primary_key=True
+        ),
+        sa.Column("day", sa.Date(), primary_key=True),
+        sa.Column("games", sa.Integer()),
+    )
+    # Backfill statistics of games expired so far, later ones are rolled up by the sweeper
+    op.execute(
+        """
+        INSERT INTO player_stats (chat_id, player_id, day, games_played, games_queued)
+        SELECT game.chat_id, association.player_id, CAST(game.timeslot AS DATE),
+            count(*) FILTER (WHERE association.in_queue = false),
+            count(*) FILTER (WHERE association.in_queue = true)
+        FROM game JOIN association ON association.game_id = game.id
+        WHERE game.expired AND game.chat_id IS NOT NULL
+        GROUP BY game.chat_id, association.player_id, CAST(game.timeslot AS DATE)
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO chat_stats (chat_id, day, games)
+        SELECT game.chat_id, CAST(game.timeslot AS DATE), count(DISTINCT game.id)
+        FROM game JOIN association ON association.game_id = game.id
+        WHERE game.expired AND game.chat_id IS NOT NULL AND association.in_queue = false
+        GROUP BY game.chat_id, CAST(game.timeslot AS DATE)
+        """
+    )
+
+
+def downgrade():
+    for table in ["chat_stats", "player_stats", "reminder"]:
+        op.drop_table(table)
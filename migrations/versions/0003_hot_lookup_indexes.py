@@ -0,0 +1,46 @@
+"""Indexes for hot lookups
+
+Created concurrently, so the bot keeps working while they are built.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # get_all_games, get_game: active games of chat ordered by timeslot
+    ("ix_game_active_chat_timeslot", "game", ["chat_id", "timeslot"], "NOT expired"),
+    # expiry sweeper: active games older than given time
+    ("ix_game_active_timeslot", "game", ["timeslot"], "NOT expired"),
+    # get_all_players_in_games, stats backfill: all games of chat
+    ("ix_game_chat_id", "game", ["chat_id"], None),
+    # get_assoc, player's games
+    ("ix_association_player_id", "association", ["player_id"], None),
+    # delete_reminders for game
+    ("ix_reminder_game_id", "reminder", ["game_id"], None),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
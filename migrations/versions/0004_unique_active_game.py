@@ -0,0 +1,86 @@
+"""One active game per chat and timeslot
+
+Duplicates created by concurrent joins are merged into the oldest game:
+their players are moved over and the duplicates are expired.
+The unique index replaces the plain one on the same columns.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 18:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+# Active games with the oldest game of the same chat and timeslot
+RANKED = """
+WITH ranked AS (
+    SELECT id, min(id) OVER (PARTITION BY chat_id, timeslot) AS keep_id
+    FROM game
+    WHERE NOT expired
+)
+"""
+
+MERGE_DUPLICATES = [
+    # Move each player to the kept game once, unless already there
+    RANKED
+    + """
+    UPDATE association AS a SET game_id = r.keep_id
+    FROM ranked AS r
+    WHERE a.game_id = r.id AND r.id <> r.keep_id
+    AND a.game_id = (
+        SELECT min(c.game_id)
+        FROM association AS c JOIN ranked AS rc ON c.game_id = rc.id
+        WHERE rc.keep_id = r.keep_id AND c.player_id = a.player_id
+    )
+    """,
+    RANKED
+    + """
+    DELETE FROM reminder
+    WHERE game_id IN (SELECT id FROM ranked WHERE id <> keep_id)
+    """,
+    RANKED
+    + """
+    UPDATE game SET expired = true
+    WHERE id IN (SELECT id FROM ranked WHERE id <> keep_id)
+    """,
+]
+
+
+def upgrade():
+    for statement in MERGE_DUPLICATES:
+        op.execute(sa.text(statement))
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "uq_game_active_chat_timeslot",
+            "game",
+            ["chat_id", "timeslot"],
+            unique=True,
+            postgresql_where=sa.text("NOT expired"),
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_game_active_chat_timeslot",
+            table_name="game",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_game_active_chat_timeslot",
+            "game",
+            ["chat_id", "timeslot"],
+            postgresql_where=sa.text("NOT expired"),
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "uq_game_active_chat_timeslot",
+            table_name="game",
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,60 @@
+import os
+
+# App settings are read on import, tests never connect to this DB
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/chettam_test")
+os.environ.setdefault("ALLOWED_CHATS_INTERNAL", "[]")
+os.environ.setdefault("ALLOWED_CHATS_EXTERNAL", "[]")
+
+from datetime import datetime as dt, timedelta
+from types import SimpleNamespace
+
+import pytest
+import pytz
+from sqlalchemy import create_engine
+
+from app.models import session, Chat, Player, Game, Association, Reminder
+from app.utils import hour_to_dt, update_cache
+from app.vars import MAIN_HOURS
+
+TIMEZONE = "Europe/Amsterdam"
+
+
+@pytest.fixture
+def db():
+    """Session bound to in-memory SQLite with tables that don't need Postgres types"""
+    engine = create_engine("sqlite://")
+    tables = [Player.__table__, Game.__table__, Association.__table__]
+    tables.append(Reminder.__table__)
+    for table in tables:
+        table.create(engine)
+    session.remove()
+    session.configure(bind=engine)
+    yield session
+    session.remove()
+
+
+@pytest.fixture
+def chat(db):
+    """Chat table uses Postgres arrays, so the chat is only put into the update cache"""
+    chat = Chat(id=-1, chat_type="group", title="test", timezone=TIMEZONE)
+    chat.main_hours = MAIN_HOURS
+    update_cache("chats")[chat.id] = chat
+    return chat
+
+
+@pytest.fixture
+def context():
+    job_queue = SimpleNamespace(run_once=lambda *args, **kwargs: None)
+    return SimpleNamespace(job_queue=job_queue)
+
+
+@pytest.fixture
+def hour():
+    """An hour whose game is still in the future"""
+    timezone = pytz.timezone(TIMEZONE)
+    now = dt.now(pytz.utc)
+    return next(
+        hour
+        for hour in range(24)
+        if hour_to_dt(hour, timezone) > now + timedelta(hours=1)
+    )
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.bot import join, leave, call
+from app.bot_utils import in_out
+from app.models import session, Game
+from app.utils import InOut
+from app.vars import MAIN_STATE
+
+
+def callback_update(user_id, data):
+    """Update of a main page button tapped by given user"""
+    user = SimpleNamespace(
+        id=user_id, username=None, first_name=f"player {user_id}", last_name=None
+    )
+    chat = SimpleNamespace(id=-1, type="group", title="test")
+    query = SimpleNamespace(
+        data=data,
+        answered=0,
+        message=SimpleNamespace(chat_id=chat.id, message_id=1),
+        edit_message_text=lambda **kwargs: None,
+    )
+    query.answer = lambda: setattr(query, "answered", query.answered + 1)
+    return SimpleNamespace(
+        effective_user=user, effective_chat=chat, callback_query=query
+    )
+
+
+@pytest.fixture
+def game_id(chat, context, hour):
+    in_out(callback_update(1, ""), context, [InOut("in", [hour])])
+    session.commit()
+    return session.query(Game).one().id
+
+
+def roster(game_id) -> list:
+    session.expire_all()
+    game = session.query(Game).get(game_id)
+    return sorted(assoc.player.first_name for assoc in game.player_game)
+
+
+def test_join_twice_from_stale_page(context, game_id):
+    for _ in range(2):
+        update = callback_update(2, f"join_{game_id}")
+        assert join(update, context) == MAIN_STATE
+        assert update.callback_query.answered == 1
+
+    assert roster(game_id) == ["player 1", "player 2"]
+
+
+def test_leave_twice_from_stale_page(context, game_id):
+    join(callback_update(2, f"join_{game_id}"), context)
+    for _ in range(2):
+        update = callback_update(2, f"leave_{game_id}")
+        assert leave(update, context) == MAIN_STATE
+        assert update.callback_query.answered == 1
+
+    assert roster(game_id) == ["player 1"]
+
+
+@pytest.mark.parametrize(
+    "handler, action", [(join, "join"), (leave, "leave"), (call, "call")]
+)
+def test_buttons_of_expired_game(context, game_id, handler, action):
+    session.query(Game).get(game_id).expired = True
+    session.commit()
+
+    update = callback_update(1, f"{action}_{game_id}")
+    assert handler(update, context) == MAIN_STATE
+    assert update.callback_query.answered == 1
+    assert roster(game_id) == ["player 1"]
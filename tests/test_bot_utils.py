@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+from app.bot_utils import (
+    in_out,
+    get_status_reply,
+    unit_of_work,
+    restricted,
+    restricted_dayoff,
+)
+from app.models import session, Game
+from app.utils import InOut
+
+
+def make_update(user_id, chat_id=-1):
+    user = SimpleNamespace(
+        id=user_id, username=None, first_name=f"player {user_id}", last_name=None
+    )
+    chat = SimpleNamespace(id=chat_id, type="group", title="test")
+    return SimpleNamespace(effective_user=user, effective_chat=chat)
+
+
+def test_status_after_in_lists_players_once(chat, context, hour):
+    for user_id in (1, 2):
+        in_out(make_update(user_id), context, [InOut("in", [hour])])
+        session.expire_all()
+
+    reply = get_status_reply(make_update(1))
+
+    assert reply.count("player 1") == 1
+    assert reply.count("player 2") == 1
+    game = session.query(Game).one()
+    assert [assoc.player.first_name for assoc in game.assoc_sorted] == [
+        "player 1",
+        "player 2",
+    ]
+
+
+def test_in_and_out_in_one_message_leaves_no_player(chat, context, hour):
+    in_out(make_update(1), context, [InOut("in", [hour])])
+    session.expire_all()
+
+    in_out(make_update(2), context, [InOut("in", [hour]), InOut("out", [hour])])
+    session.expire_all()
+
+    game = session.query(Game).filter_by(expired=False).one()
+    assert [assoc.player.first_name for assoc in game.player_game] == ["player 1"]
+    assert get_status_reply(make_update(1)).count("player 2") == 0
+
+
+def test_decorated_handler_keeps_its_name():
+    """Query count is logged under the handler's name"""
+
+    def status(update, context):
+        pass
+
+    assert unit_of_work(restricted(restricted_dayoff(status))).__name__ == "status"
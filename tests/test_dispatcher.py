@@ -0,0 +1,78 @@
+import threading
+import time
+from queue import Queue
+
+import pytest
+from telegram import Bot, Update
+from telegram.ext import Filters, JobQueue, MessageHandler
+
+from app.dispatcher import ChatOrderedDispatcher
+
+
+def make_update(update_id, chat_id, message_id) -> Update:
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "group"},
+            "text": "text",
+        },
+    }
+    return Update.de_json(data, bot=None)
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = ChatOrderedDispatcher(
+        Bot("123:test"), Queue(), job_queue=JobQueue(), workers=0, chat_workers=2
+    )
+    thread = threading.Thread(target=dispatcher.start)
+    thread.start()
+    yield dispatcher
+    dispatcher.stop()
+    thread.join()
+
+
+def test_chat_updates_are_handled_in_order(dispatcher):
+    handled = {}
+    lock = threading.Lock()
+
+    def handler(update, context):
+        time.sleep(0.001)
+        with lock:
+            handled.setdefault(update.effective_chat.id, []).append(
+                update.message.message_id
+            )
+
+    dispatcher.add_handler(MessageHandler(Filters.text, handler))
+    for message_id in range(20):
+        for chat_id in range(1, 6):
+            dispatcher.update_queue.put(make_update(0, chat_id, message_id))
+    while not dispatcher.update_queue.empty():
+        time.sleep(0.01)
+    dispatcher.stop()
+
+    assert handled == {chat_id: list(range(20)) for chat_id in range(1, 6)}
+
+
+def test_blocked_chat_does_not_stall_other_chats(dispatcher):
+    release = threading.Event()
+    handled = []
+
+    def handler(update, context):
+        if update.effective_chat.id == 1:
+            release.wait(timeout=5)
+        handled.append(update.effective_chat.id)
+
+    dispatcher.add_handler(MessageHandler(Filters.text, handler))
+    dispatcher.update_queue.put(make_update(0, 1, 0))
+    dispatcher.update_queue.put(make_update(1, 1, 1))
+    for chat_id in range(2, 6):
+        dispatcher.update_queue.put(make_update(chat_id, chat_id, 0))
+
+    deadline = time.monotonic() + 2
+    while len(handled) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(handled) == [2, 3, 4, 5]
+    release.set()
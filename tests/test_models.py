@@ -0,0 +1,52 @@
+from datetime import datetime as dt, timedelta
+
+import pytz
+
+from app.models import Player, Game
+
+
+def expected_tags(slots) -> list:
+    """Queue rules: up to 9 players the first 5 play and the rest queue,
+    from 10 players two parties of 5 play and the rest queue"""
+    tags = []
+    for index in range(slots):
+        if slots < 10:
+            tags.append(("\[_queue_] ", True) if index >= 5 else ("", False))
+        elif index < 5:
+            tags.append(("\[_1st_] ", False))
+        elif index < 10:
+            tags.append(("\[_2nd_] ", False))
+        else:
+            tags.append(("\[_queue_] ", True))
+    return tags
+
+
+def test_add_player_tags_queue(db):
+    game = Game(timeslot=dt.utcnow() + timedelta(hours=2), chat_id=-1)
+    game.create()
+    joined_at = dt.now(pytz.utc)
+    for count in range(1, 12):
+        player = Player(user_id=count, first_name=f"player {count}")
+        player.create()
+        game.add_player(player, joined_at=joined_at + timedelta(seconds=count))
+
+        assert game.slots == count
+        assert len(game.players) == count
+        tags = [(assoc.queue_tag, assoc.in_queue) for assoc in game.assoc_sorted]
+        assert tags == expected_tags(count)
+
+
+def test_remove_player_retags_queue(db):
+    game = Game(timeslot=dt.utcnow() + timedelta(hours=2), chat_id=-1)
+    game.create()
+    players = [Player(user_id=i, first_name=f"player {i}") for i in range(1, 11)]
+    for index, player in enumerate(players):
+        player.create()
+        game.add_player(player, joined_at=dt.now(pytz.utc) + timedelta(seconds=index))
+
+    game.remove_player(players[0])
+
+    assert game.slots == 9
+    assert not game.has_player(players[0])
+    tags = [(assoc.queue_tag, assoc.in_queue) for assoc in game.assoc_sorted]
+    assert tags == expected_tags(9)
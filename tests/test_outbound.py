@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from app.outbound import (
+    TokenBucket,
+    OutboundLimiter,
+    RateLimitedBot,
+    REPLY,
+    NOTIFICATION,
+)
+
+
+class Clock:
+    """Monotonic clock moved by the test"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def advance(limiter, clock, seconds):
+    """Moves the clock and wakes up waiting senders"""
+    with limiter.condition:
+        clock.now += seconds
+        limiter.condition.notify_all()
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def start(target, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def limiter(clock):
+    """One message per second globally"""
+    limiter = OutboundLimiter(clock=clock)
+    limiter.global_bucket = TokenBucket(1, 1, clock=clock)
+    return limiter
+
+
+def test_bucket_refills_over_time(clock):
+    bucket = TokenBucket(2, 1, clock=clock)
+    for _ in range(2):
+        assert bucket.wait_time(clock()) == 0
+        bucket.take()
+    assert bucket.wait_time(clock()) == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.wait_time(clock()) == 0
+
+    clock.now += 10
+    bucket.wait_time(clock())
+    assert bucket.tokens == 2
+
+
+def test_paused_bucket_waits_out_the_pause(clock):
+    bucket = TokenBucket(2, 1, clock=clock)
+    bucket.pause(5)
+    assert bucket.wait_time(clock()) == pytest.approx(5)
+
+    clock.now += 5
+    assert bucket.wait_time(clock()) == 0
+
+
+def test_replies_go_before_notifications(limiter, clock):
+    limiter.acquire(None, REPLY)
+    sent = []
+
+    def send(name, priority):
+        limiter.acquire(None, priority)
+        sent.append(name)
+
+    threads = [start(send, "notification", NOTIFICATION)]
+    wait_until(lambda: len(limiter.waiting) == 1)
+    threads.append(start(send, "reply", REPLY))
+    wait_until(lambda: len(limiter.waiting) == 2)
+
+    advance(limiter, clock, 1)
+    wait_until(lambda: sent == ["reply"])
+    advance(limiter, clock, 1)
+    for thread in threads:
+        thread.join(timeout=2)
+    assert sent == ["reply", "notification"]
+
+
+def test_chat_out_of_tokens_does_not_block_others(clock):
+    limiter = OutboundLimiter(clock=clock)
+    limiter.chat_buckets[1] = TokenBucket(1, 60, clock=clock)
+    limiter.acquire(1, REPLY)
+
+    blocked = start(limiter.acquire, 1, REPLY)
+    wait_until(lambda: len(limiter.waiting) == 1)
+    other = start(limiter.acquire, 2, REPLY)
+    other.join(timeout=2)
+
+    assert not other.is_alive()
+    assert blocked.is_alive()
+    advance(limiter, clock, 60)
+    blocked.join(timeout=2)
+    assert not blocked.is_alive()
+
+
+def test_flood_wait_pauses_chat_and_retries(clock, monkeypatch):
+    calls = []
+
+    def message(bot, endpoint, data, *args, **kwargs):
+        calls.append(clock())
+        if len(calls) == 1:
+            raise RetryAfter(5)
+        return True
+
+    monkeypatch.setattr(ExtBot, "_message", message)
+    monkeypatch.setattr(RateLimitedBot, "limiter", OutboundLimiter(clock=clock))
+    bot = RateLimitedBot(token="123:test")
+    limiter = RateLimitedBot.limiter
+
+    result = []
+    thread = start(lambda: result.append(bot._message("sendMessage", {"chat_id": 1})))
+    wait_until(lambda: len(limiter.waiting) == 1)
+    assert limiter.chat_bucket(1).paused_until == clock() + 5
+
+    advance(limiter, clock, 5)
+    thread.join(timeout=2)
+    assert result == [True]
+    assert calls == [100.0, 105.0]
@@ -0,0 +1,80 @@
+import random
+import re
+
+import pytest
+
+from app.utils import InOut, parse_in_out
+from app.vars import MAIN_HOURS, USAGE_TEXT
+
+EXPECTED = {
+    "/in 18-21 23": [InOut("in", [18, 19, 20, 21, 23])],
+    "/i 22 20-0": [InOut("in", [20, 21, 22, 23, 0])],
+    "/out 23": [InOut("out", [23])],
+    "/ou 23 22": [InOut("out", [22, 23])],
+    "/o 20-1 18": [InOut("out", [18, 20, 21, 22, 23, 0, 1])],
+    "/in 19 /out 21": [InOut("in", [19]), InOut("out", [21])],
+    "/in all": [InOut("in", None)],
+    "/out all": [InOut("out", None)],
+}
+
+
+def usage_examples() -> list:
+    return [line.strip() for line in USAGE_TEXT.splitlines() if "/" in line]
+
+
+def test_every_usage_example_is_covered():
+    examples = [
+        example for example in usage_examples() if not re.search("<|>", example)
+    ]
+    assert sorted(examples) == sorted(EXPECTED)
+
+
+@pytest.mark.parametrize("text, plan", EXPECTED.items())
+def test_usage_examples(text, plan):
+    assert parse_in_out(text, MAIN_HOURS) == plan
+
+
+@pytest.mark.parametrize(
+    "text, plan",
+    [
+        ("/in 23-1", [InOut("in", [23, 0, 1])]),
+        ("/in 1-23", [InOut("in", [])]),
+        ("/in 20-20", [InOut("in", [20])]),
+        ("/in@chettam_bot 18", [InOut("in", [18])]),
+        ("/IN 18 /Out@chettam_bot 19", [InOut("in", [18]), InOut("out", [19])]),
+        ("/in ALL", [InOut("in", None)]),
+        ("/in 12 18-25 abc 19", [InOut("in", [19])]),
+        ("/in 18 /status 19", [InOut("in", [18])]),
+        ("/in 18 18-19", [InOut("in", [18, 19])]),
+    ],
+)
+def test_edge_cases(text, plan):
+    assert parse_in_out(text, MAIN_HOURS) == plan
+
+
+@pytest.mark.parametrize("text", ["/in", "/out@chettam_bot", "/in 18 /out", "/i  "])
+def test_missing_arguments_give_usage(text):
+    assert parse_in_out(text, MAIN_HOURS) is None
+
+
+def random_message(rng) -> str:
+    words = ["/in", "/i", "/o", "/ou", "/out", "/in@bot", "/x", "all", "-", "/", " "]
+    words += [str(hour) for hour in range(-2, 30)]
+    words += [f"{rng.randint(0, 30)}-{rng.randint(0, 30)}" for _ in range(5)]
+    return " ".join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+
+
+def test_fuzz_random_messages():
+    rng = random.Random(0)
+    for _ in range(5000):
+        text = random_message(rng)
+        plan = parse_in_out(text, MAIN_HOURS)
+        if plan is None:
+            continue
+        for step in plan:
+            assert step.action in ("in", "out")
+            if step.hours is not None:
+                assert set(step.hours) <= set(MAIN_HOURS)
+                assert len(step.hours) == len(set(step.hours))
+                positions = [MAIN_HOURS.index(hour) for hour in step.hours]
+                assert positions == sorted(positions)
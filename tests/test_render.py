@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from app import render as render_module
+from app.render import render, RenderError, get_font, load_font
+from app.vars import STICKER_FONT
+
+
+def test_pool_recovers_after_worker_dies():
+    first_pid = render(os.getpid)
+
+    with pytest.raises(RenderError):
+        render(os._exit, 1)
+
+    assert render(os.getpid) not in (first_pid, os.getpid())
+
+
+def test_missing_emoji_font_falls_back_to_regular_font(monkeypatch):
+    pytest.importorskip("PIL")
+    monkeypatch.setattr(render_module, "EMOJI_FONTS", ["./missing.ttc", STICKER_FONT])
+    load_font.cache_clear()
+
+    assert get_font(20, emoji=True) is get_font(20)
+    load_font.cache_clear()
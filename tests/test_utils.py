@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime as dt, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from app import utils
+from app.models import session, Game, Reminder
+from app.utils import (
+    delete_reminders,
+    load_leetcode_problems,
+    refresh_leetcode_problems,
+)
+from app.vars import LEETCODE_CACHE_TTL
+
+CATALOG = {
+    "stat_status_pairs": [
+        {
+            "paid_only": False,
+            "difficulty": {"level": 1},
+            "stat": {
+                "question__title_slug": "two-sum",
+                "question__hide": False,
+                "total_submitted": 10,
+                "total_acs": 5,
+                "question__title": "Two Sum",
+            },
+        },
+        {
+            "paid_only": True,
+            "difficulty": {"level": 3},
+            "stat": {
+                "question__title_slug": "paid",
+                "question__hide": False,
+                "total_submitted": 1,
+                "total_acs": 1,
+            },
+        },
+    ]
+}
+
+
+def add_game_with_reminder(chat_id, fire_at) -> Game:
+    game = Game(timeslot=fire_at + timedelta(minutes=5), chat_id=chat_id)
+    game.create()
+    Reminder(game=game, kind="start", fire_at=fire_at).create()
+    return game
+
+
+def test_delete_missed_reminders_of_shard_only(db):
+    missed = dt.utcnow() - timedelta(minutes=1)
+    own = add_game_with_reminder(-2, missed)
+    other = add_game_with_reminder(-3, missed)
+    upcoming = add_game_with_reminder(-4, dt.utcnow() + timedelta(hours=1))
+
+    delete_reminders(shard=(0, 2))
+
+    left = {reminder.game_id for reminder in session.query(Reminder)}
+    assert left == {other.id, upcoming.id}
+    assert own.id not in left
+
+
+@pytest.fixture
+def leetcode(tmp_path, monkeypatch):
+    """Local stand-in for LeetCode API, responds with 'server.status'"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(CATALOG).encode()
+            self.send_response(server.status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    server.status = 200
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        utils, "LEETCODE_API_URL", f"http://127.0.0.1:{server.server_port}/"
+    )
+    monkeypatch.setattr(utils, "LEETCODE_CACHE_FILE", str(tmp_path / "leetcode.json"))
+    monkeypatch.setattr(utils, "leetcode_problems", [])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_refresh_keeps_compact_catalog(leetcode):
+    refresh_leetcode_problems()
+
+    expected = [{"slug": "two-sum", "level": 1, "submitted": 10, "accepted": 5}]
+    assert utils.leetcode_problems == expected
+    with open(utils.LEETCODE_CACHE_FILE) as cache_file:
+        assert json.load(cache_file) == expected
+
+
+def test_failed_refresh_keeps_stale_catalog(leetcode):
+    refresh_leetcode_problems()
+    stale = utils.leetcode_problems
+
+    leetcode.status = 500
+    refresh_leetcode_problems()
+
+    assert utils.leetcode_problems == stale
+    utils.leetcode_problems = []
+    load_leetcode_problems()
+    assert utils.leetcode_problems == stale
+
+
+def test_first_refresh_waits_for_cached_copy_to_age(leetcode):
+    assert load_leetcode_problems() == 0
+
+    refresh_leetcode_problems()
+    hour_ago = time.time() - 60 * 60
+    os.utime(utils.LEETCODE_CACHE_FILE, (hour_ago, hour_ago))
+    utils.leetcode_problems = []
+
+    assert load_leetcode_problems() == pytest.approx(
+        LEETCODE_CACHE_TTL - 60 * 60, abs=5
+    )
+    assert utils.leetcode_problems